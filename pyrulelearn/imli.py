@@ -6,7 +6,9 @@ import numpy as np
 import pandas as pd
 import warnings
 import math
+import os
 import random
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from time import time
 # warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -18,25 +20,65 @@ from sklearn.metrics import classification_report, accuracy_score
 
 # from pyrulelearn
 import pyrulelearn.utils
-import pyrulelearn.cplex_wrap
+import pyrulelearn.milp_wrap
 import pyrulelearn.maxsat_wrap
+import pyrulelearn.scorer
+
+
+
+def _learn_batch(model, X, y):
+    if(model.ruleType == "relaxed_CNF"):
+        pyrulelearn.milp_wrap._learnModel(model, X, y)
+    else:
+        pyrulelearn.maxsat_wrap._learnModel(model, X, y, isTest=False)
+
+
+def _learn_batch_in_worker(model, X, y):
+    # model is a copy in the worker process, so the learned rule and time statistics are returned
+    model._solver_time, model._wcnf_generation_time, model._demo_time = 0, 0, 0
+    _learn_batch(model, X, y)
+    
+    return {attribute : getattr(model, attribute) for attribute in model._batch_state()}, \
+        (model._solver_time, model._wcnf_generation_time, model._demo_time)
 
 
 
 class imli():
     def __init__(self, num_clause=5, data_fidelity=1, weight_feature=1, threshold_literal=-1, threshold_clause=-1,
                  solver="open-wbo", rule_type="CNF", batchsize=400,
-                 work_dir=".", timeout=100, verbose=False):
+                 work_dir=None, timeout=100, verbose=False, n_jobs=1, portfolio="best", transport="pipe",
+                 batching="sequential", random_state=None, patience=None, min_improvement=0,
+                 threads=1, mip_gap=None, mip_emphasis=0, node_storage="disk", compress_duplicates=False):
         '''
 
         :param numBatch: no of Batchs of training dataset
         :param numClause: no of clause in the formula
         :param dataFidelity: weight corresponding to accuracy
         :param weightFeature: weight corresponding to selected features
-        :param solver: specify the (name of the) bin of the solver; bin must be in the path
+        :param solver: specify the (name of the) bin of the solver; bin must be in the path, or 'rc2' to solve in-process with pysat.
+                       For relaxed_CNF, the MILP solver "cplex" (default) or "highs"
         :param ruleType: type of rule {CNF,DNF}
-        :param workDir: working directory
+        :param workDir: working directory for solver files, None for /dev/shm (if available) or the system temp directory
         :param verbose: True for debug
+        :param n_jobs: number of batches solved in parallel processes (-1 for all cores), 1 solves batches one at a time
+        :param portfolio: when solver is a list of MaxSAT solvers, they run on the same query and
+                          either the "first" model or the "best" model (least cost) is taken
+        :param transport: "pipe" streams the MaxSAT query to stdin of the solver and reads its answer while it runs,
+                          "file" writes the query and the answer in files of the working directory.
+                          Solvers that do not read stdin (uwrmaxsat, satlike-cw) always use "file"
+        :param batching: "sequential" for batches of consecutive samples, "shuffle" for random batches,
+                         "stratified" for random batches with the class proportions of the training set
+        :param random_state: seed of the random batches
+        :param patience: stop learning a rule when the best loss did not improve by more than min_improvement 
+                         in patience consecutive batches, None to learn on all batches
+        :param min_improvement: least decrease of the best loss that counts as an improvement
+        :param threads: number of threads of the MILP solver (relaxed_CNF), "auto" shares the cores of the machine 
+                        by the n_jobs batches solved in parallel
+        :param mip_gap: relative MIP gap at which the MILP solver stops, None for the default of the solver
+        :param mip_emphasis: MIP emphasis of CPLEX (0 balanced, 1 feasibility, 2 optimality, 3 best bound, 4 hidden feasibility)
+        :param node_storage: "disk" stores the node files of CPLEX on disk (in work_dir), "memory" keeps them in memory
+        :param compress_duplicates: encode identical samples (features and label) of a batch once, with the weight 
+                                    of their noise (slack) variable multiplied by their number
 
         --- more are added later
 
@@ -49,6 +91,11 @@ class imli():
         assert isinstance(num_clause, int)
         assert isinstance(threshold_clause, int)
         assert isinstance(threshold_clause, int)
+        assert isinstance(n_jobs, int) and n_jobs != 0
+        assert batching in ["sequential", "shuffle", "stratified"], batching
+        assert patience is None or (isinstance(patience, int) and patience > 0), patience
+        assert threads == "auto" or (isinstance(threads, int) and threads > 0), threads
+        assert node_storage in ["disk", "memory"], node_storage
 
 
         
@@ -71,16 +118,42 @@ class imli():
         self._prediction_time = 0
         self._wcnf_generation_time = 0
         self._demo_time = 0
+        self.n_jobs = n_jobs
+        self.portfolio = portfolio
+        self.transport = transport
+        self._executor = None
+        self._loss_cache = None
+        self._maxsat_session = None
+        self.batching = batching
+        self.random_state = random_state
+        self._rng = None
+        self.patience = patience
+        self.min_improvement = min_improvement
+        self._stop_reason = []
+        self._saved_solver_calls = 0
+        self.threads = threads
+        self.mip_gap = mip_gap
+        self.mip_emphasis = mip_emphasis
+        self.node_storage = node_storage
+        self.compress_duplicates = compress_duplicates
 
         
         
 
         
 
-        if(self.ruleType == "relaxed_CNF"):
+        if(self.ruleType == "relaxed_CNF" and self.solver not in pyrulelearn.milp_wrap._MILP_SOLVERS):
             self.solver = "cplex"  # this is the default solver for learning rules in relaxed_CNFs
         
     
+    def __getstate__(self):
+        # the process pool stays with the parent process
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_loss_cache'] = None
+        state['_maxsat_session'] = None
+        return state
+
     def __repr__(self):
         print("\n\nIMLI:->")
         return '\n'.join(" - %s: %s" % (item, value) for (item, value) in vars(self).items() if "_" not in item)
@@ -126,7 +199,8 @@ class imli():
     
 
     def get_work_dir(self):
-        return self.workDir
+        # the directory where solver files are written, also when work_dir is None
+        return pyrulelearn.utils._get_work_dir(self)
 
     def get_weight_data_fidelity(self):
         return self.dataFidelity
@@ -140,6 +214,156 @@ class imli():
     def get_threshold_clause(self):
         return self.threshold_clause_learned
 
+    def get_stop_reason(self):
+        # "completed", "plateau" or "timeout" for each learned rule
+        return list(self._stop_reason)
+
+    def get_saved_solver_calls(self):
+        return self._saved_solver_calls
+
+    def get_scorer(self):
+        """
+            Returns the learned rule compiled into a pyrulelearn.scorer.RuleScorer, which only needs numpy for prediction. 
+            The scorer can be saved with scorer.save(file) and loaded with RuleScorer.load(file).
+        """
+
+        if(self.ruleType == "relaxed_CNF"):
+            self._xhat = np.array(self._assignList[:self.numClause * self.numFeatures]).reshape(self.numClause, self.numFeatures)
+        xhat = np.array(self._xhat)
+        assert np.array_equal(xhat, xhat.astype(bool)), "only clauses with 0/1 weights can be compiled"
+        
+        actual_feature_len = int(self.numFeatures/2)
+        positive = [np.nonzero(xhat[eachLevel, :actual_feature_len])[0] for eachLevel in range(self.numClause)]
+        negative = [np.nonzero(xhat[eachLevel, actual_feature_len:])[0] for eachLevel in range(self.numClause)]
+        
+        # the threshold on clauses is not used in decision lists and sets
+        clause_target = []
+        threshold_clause = self.threshold_clause_learned
+        if(self.ruleType in ["decision lists", "decision sets"]):
+            clause_target = self.clause_target
+            threshold_clause = -1
+        
+        return pyrulelearn.scorer.RuleScorer(rule_type=self.ruleType, 
+                                             num_features=actual_feature_len,
+                                             positive_index=np.concatenate(positive), 
+                                             positive_ptr=np.cumsum([0] + [len(index) for index in positive]),
+                                             negative_index=np.concatenate(negative), 
+                                             negative_ptr=np.cumsum([0] + [len(index) for index in negative]),
+                                             threshold_literal=self.threshold_literal_learned,
+                                             threshold_clause=threshold_clause,
+                                             clause_target=clause_target)
+
+    def _partition(self, XTrain, yTrain):
+        # batches of the training set, random batches differ in each outer iteration
+        return pyrulelearn.utils._partition(self, XTrain, yTrain, shuffle = self.batching != "sequential", 
+                                            stratify = self.batching == "stratified", random_state = self._rng)
+
+    def _num_jobs(self):
+        return os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+
+    def _start_rule(self, num_outer_idx):
+        # solver calls of a rule, where a round of n_jobs batches counts as one call in the time budget
+        num_calls = self.iterations * num_outer_idx if self.iterations > 1 else 1
+        self._budget.start_rule(int(math.ceil(num_calls / self._num_jobs())))
+        self._rule_calls = num_calls
+        self._rule_calls_done = 0
+        self._rule_stop = None
+        self._plateau_loss = None
+        self._plateau_batches = 0
+
+    def _rule_stopped(self):
+        if(self._rule_stop is None and self._budget.expired()):
+            self._rule_stop = "timeout"
+        return self._rule_stop is not None
+
+    def _check_plateau(self, best_loss):
+        """
+            Early stopping: returns True when best_loss did not improve by more than min_improvement 
+            in the last patience batches.
+        """
+        if(self.patience is None):
+            return False
+        if(self._plateau_loss is None or best_loss < self._plateau_loss - self.min_improvement):
+            self._plateau_loss = best_loss
+            self._plateau_batches = 0
+            return False
+        self._plateau_batches += 1
+        if(self._plateau_batches >= self.patience):
+            self._rule_stop = "plateau"
+            return True
+        return False
+
+    def _end_rule(self):
+        # reason to stop learning the rule and the number of solver calls not made
+        self._stop_reason.append("completed" if self._rule_stop is None else self._rule_stop)
+        self._saved_solver_calls += self._rule_calls - self._rule_calls_done
+        if(self.verbose and self._rule_stop is not None):
+            print("\nStopped on", self._rule_stop + ",", self._rule_calls - self._rule_calls_done, "solver calls saved")
+
+    def _solver_threads(self):
+        # threads of a MILP solver call, at most the cores of the machine over all batches solved in parallel
+        if(self.threads == "auto"):
+            return max(1, (os.cpu_count() or 1) // self._num_jobs())
+        return self.threads
+
+    def _batch_state(self):
+        if(self.ruleType == "relaxed_CNF"):
+            return ["_assignList", "_selectedFeatureIndex", "threshold_literal_learned", "threshold_clause_learned"]
+        return ["_xhat", "_selectedFeatureIndex", "_assignList"]
+
+    def _learn_batches(self, XTrains, yTrains, batch_order, disable):
+        """
+            Learn a rule on each batch in batch_order and yield the batch once the learned rule is set.
+
+            When n_jobs > 1, batches are solved speculatively in rounds of n_jobs: every batch of a round 
+            starts from the rule at the beginning of the round, and the learned rules are set and yielded 
+            in batch order. Hence the best-loss selection of the caller is deterministic.
+        """
+        
+        if(self._executor is None):
+            for each_batch in tqdm(batch_order, disable = disable):
+                # time check
+                if(self._rule_stopped()):
+                    break
+                
+                if(self.verbose):
+                    print("\nTraining started for batch: ", each_batch+1)
+                start_time = time()
+                _learn_batch(self, XTrains[each_batch], yTrains[each_batch])
+                self._budget.record(time() - start_time)
+                self._rule_calls_done += 1
+                yield each_batch
+            return
+
+        batch_order = list(batch_order)
+        progress = tqdm(total = len(batch_order), disable = disable)
+        for round_start in range(0, len(batch_order), self._num_jobs()):
+            batch_round = batch_order[round_start: round_start + self._num_jobs()]
+            
+            # time check
+            if(self._rule_stopped()):
+                break
+
+            if(self.verbose):
+                print("\nTraining started for batches: ", [each_batch+1 for each_batch in batch_round])
+            start_time = time()
+            futures = [self._executor.submit(_learn_batch_in_worker, self, XTrains[each_batch], yTrains[each_batch]) for each_batch in batch_round]
+            for each_batch, future in zip(batch_round, futures):
+                state, time_statistics = future.result()
+                for attribute in state:
+                    setattr(self, attribute, state[attribute])
+                self._solver_time += time_statistics[0]
+                self._wcnf_generation_time += time_statistics[1]
+                self._demo_time += time_statistics[2]
+                progress.update(1)
+                if(each_batch == batch_round[-1]):
+                    # batches of a round are solved at the same time
+                    self._budget.record(time() - start_time)
+                # only batches whose rule is used count as solver calls made
+                self._rule_calls_done += 1
+                yield each_batch
+        progress.close()
+
     def _fit_relaxed_CNF_old(self, XTrain, yTrain):
 
         
@@ -183,7 +407,7 @@ class imli():
 
             assert len(XTrain[0]) == len(XTrain_sampled[0])
 
-            pyrulelearn.cplex_wrap._call_cplex(self, np.array(XTrain_sampled), np.array(yTrain_sampled))
+            pyrulelearn.milp_wrap._learnModel(self, np.array(XTrain_sampled), np.array(yTrain_sampled))
 
     
     def _fit_relaxed_CNF(self, XTrain, yTrain):
@@ -200,34 +424,22 @@ class imli():
         self._assignList = []
         best_loss_attribute = None
         num_outer_idx = 2
+        self._start_rule(num_outer_idx)
         for outer_idx in range(num_outer_idx):
 
             # time check
-            if(time() - self._fit_start_time > self.timeOut):
-                continue
+            if(self._rule_stopped()):
+                break
             
 
-            XTrains, yTrains = pyrulelearn.utils._numpy_partition(self, XTrain, yTrain)
-            batch_order = None
-            random_shuffle_batch = False
-            if(random_shuffle_batch):
-                batch_order = random.sample(range(self.iterations), self.iterations)
-            else:
-                batch_order = range(self.iterations)
+            XTrains, yTrains = self._partition(XTrain, yTrain)
+            batch_order = range(self.iterations)
 
-            for each_batch in tqdm(batch_order, disable = not self.verbose):
-                # time check
-                if(time() - self._fit_start_time > self.timeOut):
-                    continue
-                
-                if(self.verbose):
-                    print("\nTraining started for batch: ", each_batch+1)
-                pyrulelearn.cplex_wrap._call_cplex(self, XTrains[each_batch], yTrains[each_batch])
+            for each_batch in self._learn_batches(XTrains, yTrains, batch_order, disable = not self.verbose):
 
 
                 # performance
-                yhat = self.predict(XTrain)
-                acc = accuracy_score(yTrain, yhat)
+                acc = self._training_accuracy(XTrain, yTrain)
                 def _loss(acc, num_sample, rule_size):
                     return (1-acc) * self.dataFidelity * num_sample + rule_size * self.weightFeature
                 loss = _loss(acc, XTrain.shape[0], len(self._selectedFeatureIndex))
@@ -242,12 +454,16 @@ class imli():
                     if(best_loss_attribute is not None):
                         (self._xhat, self._selectedFeatureIndex, self._assignList, self.threshold_literal_learned, self.threshold_clause_learned) = best_loss_attribute
 
+                if(self._check_plateau(best_loss)):
+                    break
+
                 
             if(self.iterations == 1):
                 # When iteration = 1, training accuracy is optimized. So there is no point to iterate again
                 break
 
         
+        self._end_rule()
         assert best_loss_attribute is not None
         self._xhat, self._selectedFeatureIndex, self._assignList, self.threshold_literal_learned, self.threshold_clause_learned = best_loss_attribute 
         # print("Finally", self.threshold_literal_learned, self.threshold_clause_learned)
@@ -333,7 +549,7 @@ class imli():
         ruleType_orig = self.ruleType
         self.ruleType = "DNF"
         # self.timeOut = int(self.timeOut/(num_outer_idx * self.numClause))
-        self.timeOut = float(self.timeOut/self.numClause)
+        self._budget.split(self.numClause)
         k = self.numClause
         self.numClause = 1
         self.clause_target = []
@@ -342,13 +558,12 @@ class imli():
         verbose = self.verbose
         self.verbose = False
 
-        XTrain_covered = np.zeros(shape=(0,XTrain.shape[1]), dtype=bool)
+        XTrain_covered = XTrain[:0]
         yTrain_covered = np.zeros(shape=(0,), dtype=bool)
         
         time_statistics = []
         # iteratively learn a DNF clause for 1, ..., k
         for idx in range(k):
-            self._fit_start_time = time()
             
             # Trivial termination when there is no sample to classify
             if(len(yTrain) == 0):
@@ -370,14 +585,14 @@ class imli():
             self.clause_target.append(target_class)
             yTrain = (yTrain == target_class).astype(bool)
             yTrain_working = np.concatenate((yTrain, np.zeros(shape=yTrain_covered.shape, dtype=bool)))
-            XTrain_working = np.concatenate((XTrain, XTrain_covered))
+            XTrain_working = pyrulelearn.utils._concatenate_rows(XTrain, XTrain_covered)
 
             if(verbose):
                 print("\nTarget class:", target_class)
                 print("Including covered samples")
                 print("total samples:", len(yTrain_working))
                 print("target samples:", int(yTrain_working.sum()))
-                print("Time left:", self.timeOut - time() + self._fit_start_time)
+                print("Time left:", self._budget.total_left())
 
                 
             
@@ -394,11 +609,12 @@ class imli():
             best_loss = self.dataFidelity * XTrain.shape[0] + self.numFeatures * self.weightFeature
             best_loss_attribute = None
             self._assignList = []
+            self._start_rule(num_outer_idx)
             for outer_idx in range(num_outer_idx):
 
                 # time check
-                if(time() - self._fit_start_time > self.timeOut):
-                    continue
+                if(self._rule_stopped()):
+                    break
 
 
                 """
@@ -406,32 +622,15 @@ class imli():
                     1. random shuffle on batch (typically better performing)
                     2. without randomness
                 """
-                XTrains, yTrains = pyrulelearn.utils._numpy_partition(self, XTrain_working, yTrain_working)
-                
-                batch_order = None
-                random_shuffle_batch = False
-                if(random_shuffle_batch):
-                    batch_order = random.sample(range(self.iterations), self.iterations)
-                else:
-                    batch_order = range(self.iterations)
-
-                for each_batch in tqdm(batch_order, disable = not verbose):
-                    
-                    # time check
-                    if(time() - self._fit_start_time > self.timeOut):
-                        continue
-                    
-
-                    if(self.verbose):
-                        print("\nTraining started for batch: ", each_batch+1)
+                XTrains, yTrains = self._partition(XTrain_working, yTrain_working)
+                batch_order = range(self.iterations)
 
-                    pyrulelearn.maxsat_wrap._learnModel(self, XTrains[each_batch], yTrains[each_batch], isTest=False)
+                for each_batch in self._learn_batches(XTrains, yTrains, batch_order, disable = not verbose):
                     
 
                     # performance
                     self._learn_parameter()
-                    yhat = self.predict(XTrain)
-                    acc = accuracy_score(yTrain, yhat)
+                    acc = self._training_accuracy(XTrain, yTrain)
                     def _loss(acc, num_sample, rule_size):
                         return (1-acc) * self.dataFidelity * num_sample + rule_size * self.weightFeature
                     loss = _loss(acc, XTrain.shape[0], len(self._selectedFeatureIndex))
@@ -444,6 +643,9 @@ class imli():
                     else:
                         if(best_loss_attribute is not None):
                             self._assignList = best_loss_attribute[2]
+
+                    if(self._check_plateau(best_loss)):
+                        break
                     
                     # best_loss_attribute = (self._xhat, self._selectedFeatureIndex, self._assignList)
 
@@ -454,6 +656,7 @@ class imli():
                     break
                     
                 # print()
+            self._end_rule()
             if(verbose):
                 print("Max loss:", best_loss)
             assert best_loss_attribute is not None
@@ -480,7 +683,7 @@ class imli():
             mask = (yhat == 0) | (yhat != yTrain)
 
             # include covered samples
-            XTrain_covered = np.concatenate((XTrain_covered, XTrain[~mask]))
+            XTrain_covered = pyrulelearn.utils._concatenate_rows(XTrain_covered, XTrain[~mask])
             yTrain_covered = np.concatenate((yTrain_covered, yTrain_orig[~mask]))
 
             # extract uncovered and incorrectly covered samples
@@ -559,7 +762,7 @@ class imli():
         ruleType_orig = self.ruleType
         # self.ruleType = "DNF"
         # self.timeOut = int(self.timeOut/(num_outer_idx * self.numClause))
-        self.timeOut = float(self.timeOut/self.numClause)
+        self._budget.split(self.numClause)
         k = self.numClause
         self.numClause = 1
         self.clause_target = []
@@ -571,7 +774,6 @@ class imli():
         
         # iteratively learn a DNF clause for 1, ..., k iterations
         for idx in range(k):
-            self._fit_start_time = time()
                 
 
             
@@ -588,7 +790,7 @@ class imli():
                 print("\n\n\n")
                 print(idx)
                 print("total samples:", len(yTrain))
-                print("Time left:", self.timeOut - time() + self._fit_start_time)
+                print("Time left:", self._budget.total_left())
 
 
 
@@ -609,11 +811,12 @@ class imli():
             best_loss = self.dataFidelity * XTrain.shape[0] + self.numFeatures * self.weightFeature
             best_loss_attribute = None
             self._assignList = []
+            self._start_rule(num_outer_idx)
             for outer_idx in range(num_outer_idx):
 
                 # time check
-                if(time() - self._fit_start_time > self.timeOut):
-                    continue
+                if(self._rule_stopped()):
+                    break
                 
 
                 """
@@ -621,27 +824,14 @@ class imli():
                     1. random shuffle on batch (typically better performing)
                     2. without randomness
                 """
-                XTrains, yTrains = pyrulelearn.utils._numpy_partition(self, XTrain, yTrain)
-                batch_order = None
-                random_shuffle_batch = False
-                if(random_shuffle_batch):
-                    batch_order = random.sample(range(self.iterations), self.iterations)
-                else:
-                    batch_order = range(self.iterations)
+                XTrains, yTrains = self._partition(XTrain, yTrain)
+                batch_order = range(self.iterations)
 
-                for each_batch in tqdm(batch_order, disable = not verbose):
-                    # time check
-                    if(time() - self._fit_start_time > self.timeOut):
-                        continue
-                    
-                    if(self.verbose):
-                        print("\nTraining started for batch: ", each_batch+1)
-                    pyrulelearn.maxsat_wrap._learnModel(self, XTrains[each_batch], yTrains[each_batch], isTest=False)
+                for each_batch in self._learn_batches(XTrains, yTrains, batch_order, disable = not verbose):
 
                     # performance
                     self._learn_parameter()
-                    yhat = self.predict(XTrain)
-                    acc = accuracy_score(yTrain, yhat)
+                    acc = self._training_accuracy(XTrain, yTrain)
                     def _loss(acc, num_sample, rule_size):
                         return (1-acc) * self.dataFidelity * num_sample + rule_size * self.weightFeature
                     loss = _loss(acc, XTrain.shape[0], len(self._selectedFeatureIndex))
@@ -655,12 +845,16 @@ class imli():
                         if(best_loss_attribute is not None):
                             self._assignList = best_loss_attribute[2]
 
+                    if(self._check_plateau(best_loss)):
+                        break
+
                 if(self.iterations == 1):
                     # When iteration = 1, training accuracy is optimized. So there is no point to iterate again
                     break
     
                 # print()
 
+            self._end_rule()
             assert best_loss_attribute is not None
             # print("Best accuracy:", best_loss*len(XTrain))
 
@@ -748,7 +942,7 @@ class imli():
         ruleType_orig = self.ruleType
         self.ruleType = "DNF"
         # self.timeOut = int(self.timeOut/(num_outer_idx * self.numClause))
-        self.timeOut = float(self.timeOut/self.numClause)
+        self._budget.split(self.numClause)
         k = self.numClause
         self.numClause = 1
         self.clause_target = []
@@ -760,7 +954,6 @@ class imli():
         
         # iteratively learn a DNF clause for 1, ..., k iterations
         for idx in range(k):
-            self._fit_start_time = time()
                 
             # Trivial termination when there is no sample to classify
             if(len(yTrain) == 0):
@@ -775,7 +968,7 @@ class imli():
                 print("\n\n\n")
                 print(idx)
                 print("total samples:", len(yTrain))
-                print("Time left:", self.timeOut - time() + self._fit_start_time)
+                print("Time left:", self._budget.total_left())
 
 
 
@@ -796,11 +989,12 @@ class imli():
             best_loss = self.dataFidelity * XTrain.shape[0] + self.numFeatures * self.weightFeature
             best_loss_attribute = None
             self._assignList = []
+            self._start_rule(num_outer_idx)
             for outer_idx in range(num_outer_idx):
 
                 # time check
-                if(time() - self._fit_start_time > self.timeOut):
-                    continue
+                if(self._rule_stopped()):
+                    break
                 
 
                 """
@@ -808,28 +1002,15 @@ class imli():
                     1. random shuffle on batch (typically better performing)
                     2. without randomness
                 """
-                XTrains, yTrains = pyrulelearn.utils._numpy_partition(self, XTrain, yTrain)
-                batch_order = None
-                random_shuffle_batch = False
-                if(random_shuffle_batch):
-                    batch_order = random.sample(range(self.iterations), self.iterations)
-                else:
-                    batch_order = range(self.iterations)
+                XTrains, yTrains = self._partition(XTrain, yTrain)
+                batch_order = range(self.iterations)
 
-                for each_batch in tqdm(batch_order, disable = not verbose):
-                    # time check
-                    if(time() - self._fit_start_time > self.timeOut):
-                        continue
-                    
-                    if(self.verbose):
-                        print("\nTraining started for batch: ", each_batch+1)
-                    pyrulelearn.maxsat_wrap._learnModel(self, XTrains[each_batch], yTrains[each_batch], isTest=False)
+                for each_batch in self._learn_batches(XTrains, yTrains, batch_order, disable = not verbose):
 
                     
                     # performance
                     self._learn_parameter()
-                    yhat = self.predict(XTrain)
-                    acc = accuracy_score(yTrain, yhat)
+                    acc = self._training_accuracy(XTrain, yTrain)
                     def _loss(acc, num_sample, rule_size):
                         return (1-acc) * self.dataFidelity * num_sample + rule_size * self.weightFeature
                     loss = _loss(acc, XTrain.shape[0], len(self._selectedFeatureIndex))
@@ -843,6 +1024,9 @@ class imli():
                         if(best_loss_attribute is not None):
                             self._assignList = best_loss_attribute[2]
 
+                    if(self._check_plateau(best_loss)):
+                        break
+
 
                 if(self.iterations == 1):
                     # When iteration = 1, training accuracy is optimized. So there is no point to iterate again
@@ -850,6 +1034,7 @@ class imli():
     
                 # print()
 
+            self._end_rule()
             assert best_loss_attribute is not None
             # print("Best accuracy:", best_loss*len(XTrain))
 
@@ -934,10 +1119,27 @@ class imli():
     
     def fit(self, XTrain, yTrain, recursive=True):
 
+        if(self.n_jobs != 1):
+            self._executor = ProcessPoolExecutor(max_workers = self._num_jobs())
+        try:
+            self._fit(XTrain, yTrain, recursive)
+        finally:
+            self._loss_cache = None
+            pyrulelearn.maxsat_wrap._closeSession(self)
+            if(self._executor is not None):
+                self._executor.shutdown()
+                self._executor = None
+
+
+    def _fit(self, XTrain, yTrain, recursive):
+
 
         self._fit_mode = True
+        self._rng = np.random.default_rng(self.random_state)
 
-        self._fit_start_time = time()    
+        self._budget = pyrulelearn.utils._TimeBudget(self.timeOut)
+        self._stop_reason = []
+        self._saved_solver_calls = 0
         XTrain = pyrulelearn.utils._transform_binary_matrix(XTrain)
         yTrain = np.array(yTrain, dtype=bool)
         
@@ -950,7 +1152,7 @@ class imli():
 
         self.trainingSize = XTrain.shape[0]
         if(self.trainingSize > 0):
-            self.numFeatures = len(XTrain[0])
+            self.numFeatures = XTrain.shape[1]
         if(self.trainingSize < self.batchsize):
             self.batchsize = self.trainingSize
 
@@ -990,37 +1192,25 @@ class imli():
         num_outer_idx = 2
         cnt = 0
         self._assignList = []
+        self._start_rule(num_outer_idx)
         for outer_idx in range(num_outer_idx):
 
             # time check
-            if(time() - self._fit_start_time > self.timeOut):
-                continue
+            if(self._rule_stopped()):
+                break
             
 
-            XTrains, yTrains = pyrulelearn.utils._numpy_partition(self, XTrain, yTrain)
-            batch_order = None
-            random_shuffle_batch = False
-            if(random_shuffle_batch):
-                batch_order = random.sample(range(self.iterations), self.iterations)
-            else:
-                batch_order = range(self.iterations)
+            XTrains, yTrains = self._partition(XTrain, yTrain)
+            batch_order = range(self.iterations)
 
-            for each_batch in tqdm(batch_order, disable = not self.verbose):
-                # time check
-                if(time() - self._fit_start_time > self.timeOut):
-                    continue
-                
-                if(self.verbose):
-                    print("\nTraining started for batch: ", each_batch+1)
-                pyrulelearn.maxsat_wrap._learnModel(self, XTrains[each_batch], yTrains[each_batch], isTest=False)
+            for each_batch in self._learn_batches(XTrains, yTrains, batch_order, disable = not self.verbose):
 
                 
 
                 # performance
                 cnt += 1
                 self._learn_parameter()
-                yhat = self.predict(XTrain)
-                acc = accuracy_score(yTrain, yhat)
+                acc = self._training_accuracy(XTrain, yTrain)
                 def _loss(acc, num_sample, rule_size):
                     assert rule_size <= self.numFeatures
                     return (1-acc) * self.dataFidelity * num_sample + rule_size * self.weightFeature
@@ -1034,6 +1224,9 @@ class imli():
                 else:
                     if(best_loss_attribute is not None):
                         self._assignList = best_loss_attribute[2]
+
+                if(self._check_plateau(best_loss)):
+                    break
                 
                 
 
@@ -1042,6 +1235,7 @@ class imli():
                 break
 
        
+        self._end_rule()
         assert best_loss_attribute is not None
         self._xhat, self._selectedFeatureIndex, self._assignList = best_loss_attribute 
         self._learn_parameter()
@@ -1110,10 +1304,8 @@ class imli():
                 # dot_matrix = XTest.dot(self._xhat.T)
                 # y_hat = ((dot_matrix >= np.array(self.threshold_literal_learned)).sum(axis=1) >= self.threshold_clause_learned).astype(int)
 
-                # considers non zero columns only
                 start_prediction_time = time()
-                nonzero_columns = np.nonzero(np.any(self._xhat, axis=0))[0]
-                dot_matrix = XTest[:, nonzero_columns].dot(self._xhat[:, nonzero_columns].T)
+                dot_matrix = pyrulelearn.utils._clause_dot(XTest, self._xhat)
                 y_hat = ((dot_matrix >= np.array(self.threshold_literal_learned)).sum(axis=1) >= self.threshold_clause_learned).astype(int)
                 self._prediction_time += time() - start_prediction_time
         
@@ -1127,39 +1319,40 @@ class imli():
             cnt_voting_function = 0
             cnt_reach_default_rule = 0
 
-            self.coverage = [0 for _ in range(self.numClause)]
-
             assert len(self.clause_target) == self.numClause
-            for example in XTest:
-                reached_verdict = False
-                possible_outcome = []
-                for eachLevel in range(self.numClause):
-                    dot_value = np.dot(example, self._xhat[eachLevel])
-                    assert dot_value <= self.threshold_literal_learned[eachLevel]
-                    if(dot_value == self.threshold_literal_learned[eachLevel]):
-                        reached_verdict = True
-                        self.coverage[eachLevel] += 1
-                        if(self.ruleType == "decision lists"):
-                            y_hat.append(self.clause_target[eachLevel])
-                            if(eachLevel == self.numClause - 1):
-                                cnt_reach_default_rule += 1
-                            
-                            break
-                        possible_outcome.append(self.clause_target[eachLevel])
-
-                        
-                assert reached_verdict
-                if(self.ruleType == "decision sets"):
-                    # refine possible outcomes
-                    default_outcome = possible_outcome[-1]
-                    possible_outcome = possible_outcome[:-1]
-                    if(len(possible_outcome) > 0):
-                        # most frequent
-                        cnt_voting_function += 1
-                        y_hat.append(max(set(possible_outcome), key = possible_outcome.count))
-                    else:
-                        cnt_reach_default_rule += 1
-                        y_hat.append(default_outcome)
+            clause_target = np.array(self.clause_target)
+            threshold_literal = np.array(self.threshold_literal_learned)
+
+            # satisfaction of each rule in each example
+            start_prediction_time = time()
+            dot_matrix = pyrulelearn.utils._clause_dot(XTest, np.array(self._xhat))
+            assert np.all(dot_matrix <= threshold_literal)
+            satisfied = dot_matrix == threshold_literal
+            assert np.all(satisfied.any(axis=1))
+
+            if(self.ruleType == "decision lists"):
+                # first satisfied rule decides
+                first_match = np.argmax(satisfied, axis=1)
+                y_hat = clause_target[first_match]
+                satisfied = satisfied & (np.cumsum(satisfied, axis=1) == 1)
+                cnt_reach_default_rule = int(np.count_nonzero(first_match == self.numClause - 1))
+            
+            else:
+                # the last satisfied rule is the default outcome, other satisfied rules vote for their target
+                last_match = self.numClause - 1 - np.argmax(satisfied[:, ::-1], axis=1)
+                voting = satisfied.copy()
+                voting[np.arange(len(voting)), last_match] = False
+                classes = np.unique(clause_target)
+                votes = voting.astype(np.int64).dot((clause_target[:, None] == classes[None, :]).astype(np.int64))
+                has_vote = voting.any(axis=1)
+                
+                # most frequent, ties go to the smaller class
+                y_hat = np.where(has_vote, classes[np.argmax(votes, axis=1)], clause_target[last_match])
+                cnt_voting_function = int(np.count_nonzero(has_vote))
+                cnt_reach_default_rule = len(has_vote) - cnt_voting_function
+
+            self.coverage = satisfied.sum(axis=0).tolist()
+            self._prediction_time += time() - start_prediction_time
             
             if(self.verbose):
                 print("\n")
@@ -1189,6 +1382,101 @@ class imli():
         # return yhat
 
     
+    def predict_chunks(self, XTest, chunksize=100000, header="infer"):
+        """
+            Yields the predictions of consecutive blocks of samples. XTest is either an iterable of blocks, 
+            an array (also np.memmap, scipy.sparse matrix or PackedBinaryMatrix) or the path of a .npy or .csv file, 
+            which are read chunksize rows at a time (header is passed to pandas.read_csv). 
+            
+            The rule is compiled once (see get_scorer()) and complement features are not materialized, 
+            so the memory is bounded by the size of a block.
+        """
+        scorer = self.get_scorer()
+        for block in pyrulelearn.utils._row_blocks(XTest, chunksize, header):
+            if(isinstance(block, pyrulelearn.utils.PackedBinaryMatrix)):
+                yield scorer.predict_packed(block)
+            else:
+                yield scorer.predict(pyrulelearn.utils._to_dense_block(block))
+
+    def predict_iter(self, XTest, chunksize=100000, header="infer"):
+        """
+            Same as predict_chunks, but yields one prediction per sample.
+        """
+        for y_hat in self.predict_chunks(XTest, chunksize, header):
+            yield from y_hat
+
+    def _training_accuracy(self, XTrain, yTrain):
+        """
+            Returns accuracy_score(yTrain, self.predict(XTrain)) during fit. 
+
+            The satisfaction of each clause on the training set is cached as packed bits and only 
+            clauses whose row in _xhat (or threshold) changed since the last call are recomputed. 
+            For a clause with 0/1 weights, satisfaction is the AND (all literals) or the OR (one literal) 
+            of the packed feature columns, otherwise a dot product is used.
+        """
+
+        start_prediction_time = time()
+        if(self.ruleType == "relaxed_CNF"):
+            self._xhat = np.array(self._assignList[:self.numClause * self.numFeatures]).reshape(self.numClause, self.numFeatures)
+
+        cache = self._loss_cache
+        if(cache is None or cache["X"] is not XTrain or cache["y"] is not yTrain):
+            X_packed = None
+            if(not pyrulelearn.utils._has_implicit_complement(XTrain)):
+                X_packed = pyrulelearn.utils._pack_columns(XTrain)
+            cache = {
+                "X" : XTrain,
+                "y" : yTrain,
+                "X_packed" : X_packed,
+                "y_packed" : np.packbits(np.asarray(yTrain).astype(bool)),
+                "valid" : np.packbits(np.ones(len(yTrain), dtype=bool)),
+                "clauses" : {}
+            }
+            self._loss_cache = cache
+        
+        num_samples = len(yTrain)
+        valid = cache["valid"]
+        satisfied = []
+        for eachLevel in range(self.numClause):
+            row = np.asarray(self._xhat[eachLevel])
+            threshold = self.threshold_literal_learned[eachLevel]
+            cached = cache["clauses"].get(eachLevel)
+            if(cached is None or cached[1] != threshold or not np.array_equal(cached[0], row)):
+                selected = np.nonzero(row)[0]
+                is_boolean = np.all(row[selected] == 1)
+                if(threshold <= 0):
+                    clause = valid
+                elif(is_boolean and threshold > len(selected)):
+                    clause = np.zeros_like(valid)
+                elif(cache["X_packed"] is None):
+                    clause = np.packbits(XTrain.dot(row.reshape(1, -1))[:, 0] >= threshold)
+                elif(is_boolean and threshold == len(selected)):
+                    clause = np.bitwise_and.reduce(cache["X_packed"][selected], axis=0)
+                elif(is_boolean and threshold == 1):
+                    clause = np.bitwise_or.reduce(cache["X_packed"][selected], axis=0)
+                else:
+                    clause = np.packbits(XTrain[:, selected].dot(row[selected]) >= threshold)
+                cached = (row.copy(), threshold, clause)
+                cache["clauses"][eachLevel] = cached
+            satisfied.append(cached[2])
+
+        threshold_clause = self.threshold_clause_learned
+        if(threshold_clause <= 0):
+            y_hat = valid
+        elif(threshold_clause > self.numClause):
+            y_hat = np.zeros_like(valid)
+        elif(threshold_clause == self.numClause):
+            y_hat = np.bitwise_and.reduce(satisfied, axis=0)
+        elif(threshold_clause == 1):
+            y_hat = np.bitwise_or.reduce(satisfied, axis=0)
+        else:
+            count = np.unpackbits(np.array(satisfied), axis=1, count=num_samples).sum(axis=0)
+            y_hat = np.packbits(count >= threshold_clause)
+
+        num_errors = pyrulelearn.utils._popcount((y_hat ^ cache["y_packed"]) & valid)
+        self._prediction_time += time() - start_prediction_time
+        return (num_samples - num_errors) / num_samples
+
     def _learn_parameter(self):
         # parameters learned for rule
         if(self.ruleType=="CNF"):
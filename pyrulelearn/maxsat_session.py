@@ -0,0 +1,176 @@
+import threading
+from pysat.examples.rc2 import RC2
+from pysat.formula import WCNF
+from pysat.solvers import Solver
+
+# a session is restarted when its SAT oracle has more variables, as clauses of retracted batches are kept
+_SESSION_MAX_VARIABLES = 1 << 18
+
+
+class _MaxSATSession():
+    """
+        SAT oracle of RC2 kept across the batches of a fit (solver='rc2'). Feature variables 1..numClause * xSize
+        are shared by all batches, so that learned clauses and heuristics carry over, while noise and auxiliary
+        variables of each batch are fresh.
+
+        The clauses of a batch, and those added by RC2 while solving it, are active under an assumption literal
+        (activation). The batch is retracted by adding the negation of its activation literal.
+
+        The session relies on internals of RC2 (see _SessionRC2). When _sessionSupported() fails for the installed 
+        python-sat, each batch is solved by a fresh RC2 instead (incremental is False).
+    """
+
+    def __init__(self, num_feature_variables, incremental=None):
+        self.num_feature_variables = num_feature_variables
+        self.incremental = _sessionSupported() if incremental is None else incremental
+        self.solver = Solver(name="g3", use_timer=True) if self.incremental else None
+        self.top = num_feature_variables
+        self.activation = None
+
+    def reusable(self, num_feature_variables):
+        return self.num_feature_variables == num_feature_variables and self.top < _SESSION_MAX_VARIABLES
+
+    def offset(self):
+        # batch variable v > num_feature_variables is v + offset in the session
+        return self.top - self.num_feature_variables
+
+    def compute(self, formula, num_variables, phases=None, time_limit=None):
+        """
+            formula is the WCNF of a batch where variables above num_feature_variables are already shifted by offset(),
+            num_variables is the number of variables of the batch before shifting. Returns the RC2 model.
+            RC2 is interrupted after time_limit seconds (None for no limit), the model then satisfies the hard clauses only.
+        """
+        batch_top = self.top + num_variables - self.num_feature_variables
+        if(self.incremental):
+            self.activation = batch_top + 1
+            # RC2 allocates its variables after the activation literal
+            formula.nv = self.activation
+            rc2 = _SessionRC2(formula, self, list(range(1, self.num_feature_variables + 1)) + list(range(self.top + 1, batch_top + 1)))
+            oracle = self
+        else:
+            rc2 = RC2(formula)
+            oracle = rc2.oracle
+        if(phases is not None):
+            oracle.set_phases(phases)
+
+        timer = None
+        if(time_limit is not None):
+            timer = threading.Timer(time_limit, rc2.interrupt)
+            timer.start()
+        try:
+            model = rc2.compute(expect_interrupt=timer is not None)
+        finally:
+            if(timer is not None):
+                # the timer may fire after RC2 returned
+                timer.cancel()
+                timer.join()
+                oracle.clear_interrupt()
+
+        if(model is None and rc2.interrupted and oracle.solve()):
+            # RC2 only finds a model when it is optimal, so the model of the hard clauses is taken,
+            # where phases of the oracle favour the previous model
+            model = sorted([literal for literal in oracle.get_model() 
+                            if abs(literal) <= self.num_feature_variables or self.top < abs(literal) <= batch_top], key=abs)
+
+        if(self.incremental):
+            self.top = rc2.pool.top
+            self.solver.add_clause([-self.activation])
+        rc2.delete()
+        return model
+
+    def delete(self):
+        # RC2 does not own the oracle
+        pass
+
+    def close(self):
+        if(self.solver is not None):
+            self.solver.delete()
+            self.solver = None
+
+    # oracle interface used by RC2, all clauses are guarded by the activation literal of the batch
+
+    def add_clause(self, clause, no_return=True):
+        return self.solver.add_clause(list(clause) + [-self.activation], no_return=no_return)
+
+    def append_formula(self, formula, no_return=True):
+        for clause in formula:
+            self.add_clause(clause)
+
+    def solve(self, assumptions=[]):
+        return self.solver.solve(assumptions=list(assumptions) + [self.activation])
+
+    def solve_limited(self, assumptions=[], expect_interrupt=False):
+        return self.solver.solve_limited(assumptions=list(assumptions) + [self.activation], expect_interrupt=expect_interrupt)
+
+    def propagate(self, assumptions=[], phase_saving=0):
+        return self.solver.propagate(assumptions=list(assumptions) + [self.activation], phase_saving=phase_saving)
+
+    def get_core(self):
+        core = self.solver.get_core()
+        if(core is None):
+            return None
+        return [literal for literal in core if literal != self.activation]
+
+    def __getattr__(self, name):
+        return getattr(self.solver, name)
+
+
+class _SessionRC2(RC2):
+    """
+        RC2 on the oracle of a session. Soft clauses are unit clauses, so their literals are the selectors.
+    """
+
+    def __init__(self, formula, session, variables):
+        self.session = session
+        self.variables = variables
+        RC2.__init__(self, formula)
+
+    def init(self, formula, incr=False):
+        # upstream init records the selectors and weights of the soft clauses, and creates an oracle
+        # that is replaced by the session, so the hard clauses are only added to the session.
+        # The variables are mapped below, as the session has variables of retracted batches
+        assert all(len(clause) == 1 for clause in formula.soft)
+        hard, num_variables = formula.hard, formula.nv
+        formula.hard, formula.nv = [], 0
+        try:
+            RC2.init(self, formula, incr=incr)
+        finally:
+            formula.hard, formula.nv = hard, num_variables
+        self.oracle.delete()
+        self.oracle = self.session
+        self.oracle.append_formula(hard)
+
+        # the model is restricted to variables of the batch
+        for v in self.variables:
+            self.vmap.e2i[v] = v
+            self.vmap.i2e[v] = v
+
+
+_session_supported = None
+
+def _sessionSupported():
+    """
+        Checks once per process that a session solves a small formula as a fresh RC2 does, 
+        since the session depends on internals of RC2 that may change between python-sat releases.
+    """
+    global _session_supported
+    if(_session_supported is None):
+        formula = WCNF()
+        formula.append([1, 2])
+        formula.append([-1, -3])
+        formula.append([-1], weight=3)
+        formula.append([-2], weight=2)
+        formula.append([3], weight=1)
+        try:
+            rc2 = RC2(formula.copy())
+            expected = rc2.compute()
+            rc2.delete()
+            session = _MaxSATSession(0, incremental=True)
+            try:
+                model = session.compute(formula.copy(), formula.nv)
+            finally:
+                session.close()
+            _session_supported = expected is not None and model == expected
+        except Exception:
+            _session_supported = False
+    return _session_supported
@@ -1,78 +1,53 @@
 import subprocess
 import math
 import os
+import signal
+import tempfile
+import threading
 import numpy as np
-from time import time
+from itertools import chain
+from time import time, sleep
 
 # from pyrulelearn
 import pyrulelearn.utils
 
 
-def _generateWcnfFile(imli, AMatrix, yVector, xSize, WCNFFile,
-                        isTestPhase):
-
-    # learn soft clauses associated with feature variables and noise variables
-    topWeight, formula_builder = _learnSoftClauses(imli, isTestPhase, xSize,
-                                                                yVector)
-    
-    # learn hard clauses,
-    additionalVariable = 0
-    y_len = len(yVector)
-
-    precomputed_vars = [each_level * xSize for each_level in range(imli.numClause)]
-    variable_head =  y_len + imli.numClause * xSize + 1
+# number of integer tokens rendered and written to the wcnf file at a time
+_WCNF_CHUNK_SIZE = 1 << 20
 
-    for i in range(y_len):
-        noise = imli.numClause * xSize + i + 1
+# MaxSAT solvers called through their Python bindings, without a wcnf file
+_in_process_solvers = ['rc2']
 
-        # implementation of tseitin encoding
-        if (yVector[i] == 0):
-
-            new_clause = str(topWeight) + " " + str(noise)
-            
-            # for each_level in range(imli.numClause):
-                # new_clause += " " + str(additionalVariable + each_level + len(yVector) + imli.numClause * xSize + 1)
-            formula_builder.append((" ").join(map(str, [topWeight, noise] + [additionalVariable + each_level + variable_head for each_level in range(imli.numClause)] + [0])))
-            # new_clause += " 0\n"
-            # cnfClauses += new_clause
-            # numClauses += 1
-
-        
-            mask = AMatrix[i] == 1 
-            dummy = np.arange(1, xSize+1)[mask]
-            for j in dummy:
-                for each_level in range(imli.numClause):
-                    # numClauses += 1
-                    # new_clause = str(topWeight) + " -" + str(additionalVariable + variable_head + each_level) + " -" + str(j + precomputed_vars[each_level])
-                    formula_builder.append((" ").join(map(str, [topWeight, -1 * (additionalVariable + variable_head + each_level), -1 * (j + precomputed_vars[each_level]), 0])))
-                    # cnfClauses += new_clause + " 0\n"
+# MaxSAT solvers that read the wcnf query from stdin when no file is given
+_stdin_solvers = ['open-wbo', 'maxhs', 'open-wbo-inc', 'tt-open-wbo-inc']
 
-            additionalVariable += imli.numClause
 
-        else:
-        
-            mask = AMatrix[i] == 1 
-            dummy = np.arange(1, xSize+1)[mask]
-            for each_level in range(imli.numClause):
-                # cnfClauses += str(topWeight) + " " + str(noise) + " " + (" ").join(map(str, dummy + each_level * xSize)) + " 0\n"
-                formula_builder.append((" ").join(map(str, [topWeight, noise] + list(dummy + each_level * xSize) + [0])))
-                # numClauses += 1
+def _generateWcnfFile(imli, AMatrix, yVector, xSize, WCNFFile,
+                        isTestPhase, sampleWeight=None):
 
-    # cnfClauses = ("\n").join([(" ").join(map(str, each_clause)) for each_clause in formula_builder])
+    # learn soft clauses associated with feature variables and noise variables
+    topWeight, soft_clauses = _learnSoftClauses(imli, isTestPhase, xSize,
+                                                                yVector, sampleWeight)
+    
+    # learn hard clauses, only counted here and encoded while writing
+    num_hard_clauses, additionalVariable, hard_clauses = _learnHardClauses(imli, AMatrix, yVector, xSize, topWeight)
+    variable_head = len(yVector) + imli.numClause * xSize + 1
+    num_variables = additionalVariable + variable_head - 1
 
 
     # write in wcnf format
     start_demo_time = time()
-    num_clauses = len(formula_builder)
-    header = 'p wcnf ' + str(additionalVariable + variable_head - 1) + ' ' + str(num_clauses) + ' ' + str(topWeight) + "\n"
+    num_clauses = len(soft_clauses) + num_hard_clauses
+    header = 'p wcnf ' + str(num_variables) + ' ' + str(num_clauses) + ' ' + str(topWeight) + "\n"
     
-    with open(WCNFFile, 'w') as file:
-        file.write(header)
-        # write in chunck of 500 clauses
-        # chunck_size = 500
-        # for i in range(0, num_clauses, chunck_size):
-        #     file.writelines(' '.join(str(var) for var in clause) + '\n' for clause in formula_builder[i:i + chunck_size])
-        file.write("\n".join(formula_builder))
+    if(isinstance(WCNFFile, str)):
+        with open(WCNFFile, 'w') as file:
+            file.write(header)
+            _writeClauses(file, chain(_softClauseChunks(soft_clauses), hard_clauses))
+    else:
+        # an open stream, e.g., stdin of the solver
+        WCNFFile.write(header)
+        _writeClauses(WCNFFile, chain(_softClauseChunks(soft_clauses), hard_clauses))
 
     imli._demo_time += time() - start_demo_time
 
@@ -82,77 +57,216 @@ def _generateWcnfFile(imli, AMatrix, yVector, xSize, WCNFFile,
         
 
 
-
-def _learnSoftClauses(imli, isTestPhase, xSize, yVector):
-    # cnfClauses = ''
-    # numClauses = 0
-
-    
-    formula_builder = []
+def _writeClauses(file, clause_chunks):
+    """
+        Render chunks of clause tokens and write them as soon as they are made, so that
+        only one chunk of the formula is held in memory. Clauses are separated by a newline
+        and the file does not end with one.
+    """
+    is_first_chunk = True
+    for tokens in clause_chunks:
+        if(len(tokens) == 0):
+            continue
+        if(not is_first_chunk):
+            file.write("\n")
+        file.write(_tokensToWcnf(tokens))
+        is_first_chunk = False
+
+
+def _softClauseChunks(soft_clauses):
+    # soft clauses are rows of (weight, literal)
+    rows_per_chunk = max(_WCNF_CHUNK_SIZE // 3, 1)
+    for i in range(0, len(soft_clauses), rows_per_chunk):
+        chunk = soft_clauses[i: i + rows_per_chunk]
+        yield np.column_stack((chunk, np.zeros(len(chunk), dtype=np.int64))).ravel()
+
+
+def _learnHardClauses(imli, AMatrix, yVector, xSize, topWeight):
+    """
+        Count the hard clauses in a first pass over the samples.
+
+        Returns the number of hard clauses, the number of auxiliary variables and a generator
+        of token chunks (see _encodeHardClauses), each chunk covering consecutive samples
+    """
+
+    k = imli.numClause
+    negative = np.asarray(yVector).astype(float) == 0
+    y_len = len(negative)
+
+    num_active = np.zeros(y_len, dtype=np.int64)
+    if(pyrulelearn.utils._has_implicit_complement(AMatrix)):
+        # exactly one of x_j and not x_j is active
+        num_active[:] = AMatrix.num_features
+    else:
+        # active features are counted in blocks of samples to avoid a copy of the batch
+        AMatrix = np.asarray(AMatrix).reshape(y_len, xSize)
+        rows_per_block = max(_WCNF_CHUNK_SIZE // max(xSize, 1), 1)
+        for i in range(0, y_len, rows_per_block):
+            num_active[i: i + rows_per_block] = np.count_nonzero(AMatrix[i: i + rows_per_block] == 1, axis=1)
+
+    noise = k * xSize + np.arange(y_len) + 1
+    aux_head = _auxiliaryHead(imli, negative, xSize)
+
+    # number of tokens and clauses of each sample
+    block_len = np.where(negative, k + 3 + 4 * k * num_active, k * (num_active + 3))
+    num_hard_clauses = int(np.where(negative, 1 + k * num_active, k).sum())
+    additionalVariable = k * int(negative.sum())
+
+    # a sample is never split across chunks
+    chunk_index = (np.cumsum(block_len) - 1) // _WCNF_CHUNK_SIZE
+    boundaries = [0] + (np.nonzero(np.diff(chunk_index))[0] + 1).tolist() + [y_len]
+
+    def _chunks():
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            if(start == end):
+                continue
+            yield _encodeHardClauses(imli, AMatrix[start:end], negative[start:end], num_active[start:end],
+                                     noise[start:end], aux_head[start:end], xSize, topWeight)
+
+    return num_hard_clauses, additionalVariable, _chunks()
+
+
+def _auxiliaryHead(imli, negative, xSize):
+    # first auxiliary variable of each negative sample
+    variable_head = len(negative) + imli.numClause * xSize + 1
+    return variable_head + imli.numClause * (np.cumsum(negative) - negative)
+
+
+def _warmStartAssignment(imli, AMatrix, yVector, xSize):
+    """
+        Extends the model of the previous batch (_assignList) to the samples of this batch, which gives
+        a satisfying assignment of the hard clauses: a sample is noise when the previous rule misclassifies it,
+        and the auxiliary variable z_l of a negative sample is true when no active feature is selected in level l.
+        Used by the in-process solver (rc2) only.
+    """
+    k = imli.numClause
+    negative = np.asarray(yVector).astype(float) == 0
+    selected = (np.array(imli._assignList) > 0).reshape(k, xSize).astype(np.int64)
+    level_satisfied = pyrulelearn.utils._clause_dot(AMatrix, selected) > 0
+    noise = np.where(negative, level_satisfied.all(axis=1), ~level_satisfied.all(axis=1))
+
+    noise_literal = (k * xSize + np.arange(len(negative)) + 1) * np.where(noise, 1, -1)
+    aux_literal = (_auxiliaryHead(imli, negative, xSize)[negative][:, None] + np.arange(k)[None, :]) * np.where(level_satisfied[negative], -1, 1)
+    return np.concatenate((imli._assignList, noise_literal, aux_literal.reshape(-1))).astype(np.int64).tolist()
+
+
+def _encodeHardClauses(imli, AMatrix, negative, num_active, noise, aux_head, xSize, topWeight):
+    """
+        Tseitin encoding of a block of samples at once. Each clause is laid out as a block of
+        integer tokens (weight, literals) terminated by 0, samples appear in their original order,
+        so the text is identical to encoding one sample (one feature, one level) at a time.
+
+        For a negative sample i with auxiliary variables z_1, ..., z_k:
+            noise_i OR z_1 OR ... OR z_k
+            NOT z_l OR NOT b_{l,j}          for each active feature j and level l
+        For a positive sample i:
+            noise_i OR (OR of b_{l,j} over active features j)   for each level l
+    """
+
+    k = imli.numClause
+    levels = np.arange(k)
+    level_offset = levels * xSize
+
+    block_len = np.where(negative, k + 3 + 4 * k * num_active, k * (num_active + 3))
+    block_start = np.cumsum(block_len) - block_len
+
+    tokens = np.empty(int(block_len.sum()), dtype=np.int64)
+
+    # position of each active literal within its sample
+    rows, cols = pyrulelearn.utils._active_literals(AMatrix)
+    row_start = np.cumsum(num_active) - num_active
+    rank = np.arange(len(rows)) - row_start[rows]
+    literal = cols[:, None] + 1 + level_offset[None, :]
+
+    # negative samples: long clause with the noise and auxiliary variables
+    neg_idx = np.nonzero(negative)[0]
+    head_pos = block_start[neg_idx][:, None] + np.arange(k + 3)[None, :]
+    head = np.empty((len(neg_idx), k + 3), dtype=np.int64)
+    head[:, 0] = topWeight
+    head[:, 1] = noise[neg_idx]
+    head[:, 2:k + 2] = aux_head[neg_idx][:, None] + levels[None, :]
+    head[:, k + 2] = 0
+    tokens[head_pos] = head
+
+    # negative samples: binary clauses for each active feature and level
+    mask = negative[rows]
+    neg_rows = rows[mask]
+    clause_pos = block_start[neg_rows][:, None] + k + 3 + 4 * (rank[mask][:, None] * k + levels[None, :])
+    tokens[clause_pos] = topWeight
+    tokens[clause_pos + 1] = -(aux_head[neg_rows][:, None] + levels[None, :])
+    tokens[clause_pos + 2] = -literal[mask]
+    tokens[clause_pos + 3] = 0
+
+    # positive samples: one clause per level over active features
+    pos_idx = np.nonzero(~negative)[0]
+    clause_pos = block_start[pos_idx][:, None] + levels[None, :] * (num_active[pos_idx][:, None] + 3)
+    tokens[clause_pos] = topWeight
+    tokens[clause_pos + 1] = noise[pos_idx][:, None]
+    tokens[clause_pos + num_active[pos_idx][:, None] + 2] = 0
+    mask = ~mask
+    pos_rows = rows[mask]
+    literal_pos = block_start[pos_rows][:, None] + levels[None, :] * (num_active[pos_rows][:, None] + 3) + 2 + rank[mask][:, None]
+    tokens[literal_pos] = literal[mask]
+
+    return tokens
+
+
+def _tokensToWcnf(tokens):
+    # every distinct token of the chunk is converted to a string once and looked up,
+    # so that the table is bounded by the chunk and not by the number of variables
+    values, index = np.unique(tokens, return_inverse=True)
+    table = values.astype(str).astype(object)
+
+    # 0 is only used as clause terminator, so a line ends after every " 0"
+    return " ".join(table[index].tolist()).replace(" 0 ", " 0\n")
+
+
+
+def _learnSoftClauses(imli, isTestPhase, xSize, yVector, sampleWeight=None):
+    """
+        Returns the top weight and the soft clauses as rows of (weight, literal). 
+        sampleWeight is the multiplicity of each sample when duplicate samples are compressed, 
+        which multiplies the weight of its noise variable.
+    """
+
+    num_feature_variables = imli.numClause * xSize
+    feature_variables = np.arange(1, num_feature_variables + 1, dtype=np.int64)
+    noise_variables = np.arange(num_feature_variables + 1, num_feature_variables + len(yVector) + 1, dtype=np.int64)
+    assignList = np.array(imli._assignList, dtype=np.int64)
+    noise_weight = imli.dataFidelity
+    num_weighted_samples = len(yVector)
+    if(sampleWeight is not None):
+        noise_weight = imli.dataFidelity * np.asarray(sampleWeight, dtype=np.int64)
+        num_weighted_samples = int(np.sum(sampleWeight))
 
     if (isTestPhase):
-        topWeight = imli.dataFidelity * len(yVector) + 1 + imli.weightFeature * xSize * imli.numClause
-        # numClauses = 0
-        for i in range(1, imli.numClause * xSize + 1):
-            # numClauses += 1
-            # cnfClauses += str(imli.weightFeature) + ' ' + str(-i) + ' 0\n'
-            formula_builder.append((" ").join(map(str, [imli.weightFeature, -i, 0])))
-        for i in range(imli.numClause * xSize + 1, imli.numClause * xSize + len(yVector) + 1):
-            # numClauses += 1
-            # cnfClauses += str(imli.dataFidelity) + ' ' + str(-i) + ' 0\n'
-            formula_builder.append((" ").join(map(str, [imli.dataFidelity, -i, 0])))
-
-        # for testing, the positive assigned feature variables are converted to hard clauses
-        # so that  their assignment is kept consistent and only noise variables are considered soft,
-        for each_assign in imli._assignList:
-            # numClauses += 1
-            # cnfClauses += str(topWeight) + ' ' + str(each_assign) + ' 0\n'
-            formula_builder.append((" ").join(map(str, [topWeight, each_assign, 0])))
+        topWeight = imli.dataFidelity * num_weighted_samples + 1 + imli.weightFeature * xSize * imli.numClause
+        clause_blocks = [(imli.weightFeature, -feature_variables),
+                         (noise_weight, -noise_variables),
+                         # for testing, the positive assigned feature variables are converted to hard clauses
+                         # so that  their assignment is kept consistent and only noise variables are considered soft,
+                         (topWeight, assignList)]
     else:
-        # applicable for the 1st Batch
-        isEmptyAssignList = True
+        # previous assignment of feature variables is kept with the same weight for both phases
+        clause_blocks = [(imli.weightFeature, assignList),
+                         # noise variables are to be kept consisitent (not necessary though)
+                         (noise_weight, -noise_variables)]
 
-        total_additional_weight = 0
-        positiveLiteralWeight = imli.weightFeature
-        for each_assign in imli._assignList:
-            isEmptyAssignList = False
-            # numClauses += 1
-            if (each_assign > 0):
+        # for the first step
+        if (len(assignList) == 0):
+            clause_blocks.append((imli.weightFeature, -feature_variables))
 
-                # cnfClauses += str(positiveLiteralWeight) + ' ' + str(each_assign) + ' 0\n'
-                formula_builder.append((" ").join(map(str, [positiveLiteralWeight, each_assign, 0])))
-                total_additional_weight += positiveLiteralWeight
+        total_additional_weight = imli.weightFeature * (len(assignList) if len(assignList) > 0 else num_feature_variables)
+        topWeight = int(imli.dataFidelity * num_weighted_samples + 1 + total_additional_weight)
 
-            else:
-                # cnfClauses += str(imli.weightFeature) + ' ' + str(each_assign) + ' 0\n'
-                formula_builder.append((" ").join(map(str, [imli.weightFeature, each_assign, 0])))
-                total_additional_weight += imli.weightFeature
+    soft_clauses = np.zeros((0, 2), dtype=np.int64)
+    for weight, literals in clause_blocks:
+        soft_clauses = np.concatenate((soft_clauses, np.column_stack((np.broadcast_to(np.asarray(weight, dtype=np.int64), len(literals)), literals))))
 
-        # noise variables are to be kept consisitent (not necessary though)
-        for i in range(imli.numClause * xSize + 1,
-                        imli.numClause * xSize + len(yVector) + 1):
-            # numClauses += 1
-            # cnfClauses += str(imli.dataFidelity) + ' ' + str(-i) + ' 0\n'
-            formula_builder.append((" ").join(map(str, [imli.dataFidelity, -i, 0])))
-
-        # for the first step
-        if (isEmptyAssignList):
-            for i in range(1, imli.numClause * xSize + 1):
-                # numClauses += 1
-                # cnfClauses += str(imli.weightFeature) + ' ' + str(-i) + ' 0\n'
-                formula_builder.append((" ").join(map(str, [imli.weightFeature, -i, 0])))
-                total_additional_weight += imli.weightFeature
-
-        topWeight = int(imli.dataFidelity * len(yVector) + 1 + total_additional_weight)
-
-    # print(formula_builder)
-    # cnfClauses = ("\n").join([(" ").join(map(str, each_clause)) for each_clause in formula_builder])
-    # assert dummy == cnfClauses[:-1]
-    # quit()
     if(imli.verbose):
-        print("- number of soft clauses: ", len(formula_builder))
+        print("- number of soft clauses: ", len(soft_clauses))
 
-    return topWeight, formula_builder
+    return topWeight, soft_clauses
 
 
 
@@ -196,38 +310,192 @@ def _cmd_exists(imli, cmd):
     return subprocess.call("type " + cmd, shell=True, 
         stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
 
-def _learnModel(imli, X, y, isTest):
-    # X = pyrulelearn.utils._add_dummy_columns(X)
+def _generateWcnfFormula(imli, AMatrix, yVector, xSize, isTestPhase, offset=0, sampleWeight=None):
+    """
+        Same MaxSAT query as _generateWcnfFile, built as a pysat WCNF object from the integer clause arrays.
+        Noise and auxiliary variables are shifted by offset.
+    """
+    from pysat.formula import WCNF
+
+    topWeight, soft_clauses = _learnSoftClauses(imli, isTestPhase, xSize, yVector, sampleWeight)
+    num_hard_clauses, additionalVariable, hard_clauses = _learnHardClauses(imli, AMatrix, yVector, xSize, topWeight)
+    num_feature_variables = imli.numClause * xSize
+
+    formula = WCNF()
+    formula.nv = additionalVariable + len(yVector) + num_feature_variables + offset
+    formula.topw = topWeight
+
+    # soft clauses with the top weight are hard in the wcnf format
+    is_hard = soft_clauses[:, 0] >= topWeight
+    soft_literals = _shiftVariables(soft_clauses[:, 1], num_feature_variables, offset)
+    formula.hard = [[literal] for literal in soft_literals[is_hard].tolist()]
+    for tokens in hard_clauses:
+        formula.hard.extend(_tokensToClauses(tokens, num_feature_variables, offset))
+    formula.soft = [[literal] for literal in soft_literals[~is_hard].tolist()]
+    formula.wght = soft_clauses[~is_hard, 0].tolist()
 
-    # temp files to save maxsat query in wcnf format
-    WCNFFile = imli.workDir + "/" + "model.wcnf"
-    outputFileMaxsat = imli.workDir + "/" + "model_out.txt"
-    num_features = len(X[0])
-    num_samples = len(y)
+    if(imli.verbose):
+        print("- number of Boolean variables:", formula.nv - offset)
+
+    return formula
+
+
+def _shiftVariables(literals, num_feature_variables, offset):
+    # variables above the feature variables are moved by offset
+    if(offset == 0):
+        return literals
+    return np.where(np.abs(literals) > num_feature_variables, literals + np.sign(literals) * offset, literals)
+
+
+def _tokensToClauses(tokens, num_feature_variables=0, offset=0):
+    # each clause is (weight, literals, 0), the weight is dropped
+    ends = np.nonzero(tokens == 0)[0]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    if(offset != 0):
+        literals = _shiftVariables(tokens, num_feature_variables, offset)
+        literals[starts] = tokens[starts]
+        tokens = literals
+    tokens = tokens.tolist()
+    return [tokens[start + 1: end] for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def _callInProcessSolver(imli, X, yVector, num_features, isTest, warmStart=None, sampleWeight=None):
+    """
+        Solve the MaxSAT query with RC2 from pysat (pip install python-sat) in the same process.
+        RC2 is interrupted at the time limit of the call, and then returns a model of the hard clauses.
+
+        The SAT oracle is kept in a session across batches (see maxsat_session), where noise and auxiliary 
+        variables of the batch are shifted to fresh variables. warmStart is an assignment that sets the phases of the oracle.
+        Only this backend is warm started: the binary MaxSAT solvers (_callSolver) take no initial assignment.
+    """
+    try:
+        import pyrulelearn.maxsat_session
+    except ImportError:
+        raise ImportError("solver='rc2' requires the python-sat package")
+
+    num_feature_variables = imli.numClause * num_features
+    if(imli._maxsat_session is None or not imli._maxsat_session.reusable(num_feature_variables)):
+        _closeSession(imli)
+        imli._maxsat_session = pyrulelearn.maxsat_session._MaxSATSession(num_feature_variables)
+    session = imli._maxsat_session
+    offset = session.offset()
 
     start_wcnf_generation = time()
-    # generate maxsat query for dataset
-    if (imli.ruleType == 'DNF'):
-        #  negate yVector for DNF rules
-        _generateWcnfFile(imli, X, [1 - int(y[each_y]) for each_y in
-                                    range(num_samples)],
-                                num_features, WCNFFile,
-                                isTest)
+    formula = _generateWcnfFormula(imli, X, yVector, num_features, isTest, offset, sampleWeight)
+    imli._wcnf_generation_time += time() - start_wcnf_generation
 
-    elif(imli.ruleType == "CNF"):
-        _generateWcnfFile(imli, X, y, num_features,
-                                WCNFFile,
-                                isTest)
-    else:
-        print("\n\nError rule type")
+    if(warmStart is not None):
+        # the SAT oracle tries the previous model first
+        warmStart = _shiftVariables(np.array(warmStart), num_feature_variables, offset).tolist()
 
-    imli._wcnf_generation_time += time() - start_wcnf_generation
+    solver_start_time = time()
+    model = session.compute(formula, formula.nv - offset, warmStart, max(imli._budget.call_limit(), 1))
+    imli._solver_time += time() - solver_start_time
+
+    if(model is None):
+        return np.zeros(0, dtype=np.int32)
+    return _shiftVariables(np.array(model, dtype=np.int64), num_feature_variables, -offset).astype(np.int32)
+
+
+def _closeSession(imli):
+    if(getattr(imli, "_maxsat_session", None) is not None):
+        imli._maxsat_session.close()
+        imli._maxsat_session = None
+
+
+def _callSolver(imli, X, yVector, num_features, isTest, sampleWeight=None):
+    if(imli.transport not in ["pipe", "file"]):
+        raise ValueError(imli.transport)
+    elif(imli.transport == "pipe" and not isinstance(imli.solver, (list, tuple)) and imli.solver in _stdin_solvers):
+        return _callSolverThroughPipe(imli, X, yVector, num_features, isTest, sampleWeight)
+    # other solvers, and portfolios, read the query from a file
+
+    # unique temp files to save maxsat query in wcnf format, so that several models can share a working directory
+    file_descriptor, WCNFFile = tempfile.mkstemp(prefix="model_", suffix=".wcnf", dir=pyrulelearn.utils._get_work_dir(imli))
+    os.close(file_descriptor)
+    outputFileMaxsat = WCNFFile[:-len(".wcnf")] + "_out.txt"
+
+    try:
+        start_wcnf_generation = time()
+        # generate maxsat query for dataset
+        _generateWcnfFile(imli, X, yVector, num_features, WCNFFile, isTest, sampleWeight)
+
+        imli._wcnf_generation_time += time() - start_wcnf_generation
 
+        
+        solver_start_time = time()
+        # call a maxsat solver, or a portfolio of solvers on the same wcnf file
+        if(isinstance(imli.solver, (list, tuple))):
+            fields = _callPortfolio(imli, WCNFFile, outputFileMaxsat)
+        else:
+            with open(outputFileMaxsat, 'w') as output:
+                subprocess.call(_solverCommand(imli, imli.solver, WCNFFile), stdout=output)
+            fields, _ = _readSolution(imli.solver, outputFileMaxsat)
+        imli._solver_time += time() - solver_start_time
     
-    solver_start_time = time()
-    # call a maxsat solver
-    if(imli.solver in ["open-wbo", "maxhs", 'satlike-cw', 'uwrmaxsat', 'tt-open-wbo-inc', 'open-wbo-inc']):  # solver has timeout and experimented with open-wbo only
-        # if(_cmd_exists(imli, imli.solver)):
+    finally:
+        # delete temp files
+        for temp_file in [WCNFFile, outputFileMaxsat]:
+            if(os.path.exists(temp_file)):
+                os.remove(temp_file)
+
+    return fields
+
+
+def _callSolverThroughPipe(imli, X, yVector, num_features, isTest, sampleWeight=None):
+    """
+        Stream the maxsat query to stdin of the solver while it runs and parse the model from its output,
+        no file is written on disk. Only for solvers in _stdin_solvers.
+    """
+
+    writer_time = [0]
+    writer_error = [None]
+    def _write_query(process):
+        start_wcnf_generation = time()
+        try:
+            with process.stdin as stream:
+                try:
+                    _generateWcnfFile(imli, X, yVector, num_features, stream, isTest, sampleWeight)
+                except BrokenPipeError:
+                    raise
+                except BaseException as error:
+                    # the solver must not answer a truncated query, the error is raised by the caller
+                    writer_error[0] = error
+                    process.kill()
+        except BrokenPipeError:
+            # solver stopped reading, e.g., after the time limit
+            pass
+        writer_time[0] = time() - start_wcnf_generation
+
+    process = None
+    try:
+        solver_start_time = time()
+        process = subprocess.Popen(_solverCommand(imli, imli.solver, None), stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, text=True)
+        writer = threading.Thread(target=_write_query, args=(process,), daemon=True)
+        writer.start()
+        fields, _ = _readSolution(imli.solver, process.stdout)
+        process.wait()
+        writer.join()
+        if(writer_error[0] is not None):
+            raise writer_error[0]
+        imli._wcnf_generation_time += writer_time[0]
+        imli._solver_time += time() - solver_start_time - writer_time[0]
+    finally:
+        if(process is not None and process.poll() is None):
+            process.kill()
+            process.wait()
+
+    return fields
+
+
+def _solverCommand(imli, solver, WCNFFile):
+    """
+        Returns the arguments to call the solver on WCNFFile, or on stdin when WCNFFile is None
+    """
+    query = [] if WCNFFile is None else [WCNFFile]
+    if(solver in ["open-wbo", "maxhs", 'satlike-cw', 'uwrmaxsat', 'tt-open-wbo-inc', 'open-wbo-inc']):  # solver has timeout and experimented with open-wbo only
+        # if(_cmd_exists(imli, solver)):
         if(True):
             # timeout_ = None
 
@@ -241,99 +509,161 @@ def _learnModel(imli, X, y, isTest):
 
             # assert timeout_ != None
 
-            # left time is allocated for the solver
-            timeout_ = max(int(imli.timeOut - time() + imli._fit_start_time), 5)
+            # time limit of the call from the time budget of the rule
+            timeout_ = max(int(math.ceil(imli._budget.call_limit())), 5)
 
             
-            if(imli.solver in ['open-wbo', 'maxhs', 'uwrmaxsat']):
-                    cmd = imli.solver + '   ' + WCNFFile + ' -cpu-lim=' + str(timeout_) + ' > ' + outputFileMaxsat
+            if(solver in ['open-wbo', 'maxhs', 'uwrmaxsat']):
+                    cmd = [solver] + query + ['-cpu-lim=' + str(timeout_)]
             # incomplete solvers
-            elif(imli.solver in ['satlike-cw', 'tt-open-wbo-inc', 'open-wbo-inc']):
-                cmd = "timeout " + str(timeout_) + " " + imli.solver + '   ' + WCNFFile + ' > ' + outputFileMaxsat
+            elif(solver in ['satlike-cw', 'tt-open-wbo-inc', 'open-wbo-inc']):
+                cmd = ["timeout", str(timeout_), solver] + query
             else:
                 raise ValueError
             
         else:
             raise Exception("Solver not found")   
     else:
-        raise Warning(imli.solver + " not configured as a MaxSAT solver in this implementation")
-        cmd = imli.solver + '   ' + WCNFFile + ' > ' + outputFileMaxsat
+        raise Warning(solver + " not configured as a MaxSAT solver in this implementation")
+        cmd = [solver] + query
 
     # print(cmd)
+    return cmd
 
-    os.system(cmd)
-    imli._solver_time += time() - solver_start_time
-    
-
-    # delete temp files
-    # cmd = "rm " + WCNFFile
-    # os.system(cmd)
-
-    
 
+def _readSolution(solver, outputFileMaxsat):
+    """
+        Returns the last model reported by the solver and the cost of the last 'o' line (None if not reported).
+        outputFileMaxsat is either a path or the output stream of the running solver
+    """
 
     solution = ''
+    cost = None
+
+    # read line by line, only the last model is parsed
+    with (open(outputFileMaxsat) if isinstance(outputFileMaxsat, str) else outputFileMaxsat) as f:
+        for line in f:
+            if (line.lstrip().startswith('v')):
+                solution = line
+            elif (line.startswith('o ')):
+                cost = int(line.split()[1])
+
+    return _parseModel(solver, solution), cost
+
+
+def _parseModel(solver, solution):
+    """
+        Returns the literals of the 'v' line as an int32 array
+    """
+    solution = solution.strip().strip('v ')
+    if(solver in ['satlike-cw', 'tt-open-wbo-inc']):
+        # solution is a bitstring where i-th bit is the value of the i-th variable
+        bits = np.frombuffer(solution.encode(), dtype=np.uint8) == ord("1")
+        variables = np.arange(1, len(bits) + 1, dtype=np.int32)
+        return np.where(bits, variables, -variables)
+    return np.fromstring(solution, dtype=np.int32, sep=" ")
+
+
+def _callPortfolio(imli, WCNFFile, outputFileMaxsat):
+    """
+        Run every solver in imli.solver concurrently on the same wcnf file.
+        With imli.portfolio == "first", the first solver that returns a model is taken and the rest are stopped.
+        With imli.portfolio == "best", the model of least cost is taken, ties are broken by the order in imli.solver.
+    """
+
+    if(imli.portfolio not in ["first", "best"]):
+        raise ValueError(imli.portfolio)
+
+    processes = []
+    for idx, solver in enumerate(imli.solver):
+        output_file = outputFileMaxsat + "." + str(idx)
+        with open(output_file, 'w') as output:
+            processes.append((solver, output_file, subprocess.Popen(_solverCommand(imli, solver, WCNFFile),
+                                                                    stdout=output, start_new_session=True)))
+
+    results = [None for _ in processes]
+    running = list(range(len(processes)))
+    while(len(running) > 0):
+        for idx in list(running):
+            solver, output_file, process = processes[idx]
+            if(process.poll() is None):
+                continue
+            running.remove(idx)
+            results[idx] = _readSolution(solver, output_file)
+            os.remove(output_file)
+            if(imli.portfolio == "first" and len(results[idx][0]) > 0):
+                for other in running:
+                    os.killpg(processes[other][2].pid, signal.SIGKILL)
+                    processes[other][2].wait()
+                    os.remove(processes[other][1])
+                running = []
+                break
+        if(len(running) > 0):
+            sleep(0.01)
+
+    best_cost, best_fields = math.inf, np.zeros(0, dtype=np.int32)
+    for result in results:
+        if(result is None or len(result[0]) == 0):
+            continue
+        fields, cost = result
+        cost = math.inf if cost is None else cost
+        if(len(best_fields) == 0 or cost < best_cost):
+            best_cost, best_fields = cost, fields
+    return best_fields
 
-    # # parse result of maxsat solving
-    # f = open(outputFileMaxsat, 'r')
-    # lines = f.readlines()
-    # f.close()
-    # # Always consider the last solution
-    # for line in lines:
-    #     if (line.strip().startswith('v')):
-    #         solution = line.strip().strip('v ')
-
-    # read line by line
-    with open(outputFileMaxsat) as f:
-        line = f.readline()
-        while line:
-            if (line.strip().startswith('v')):
-                solution = line.strip().strip('v ')     
-            line = f.readline()
-
-            
-    if(imli.solver in ['satlike-cw', 'tt-open-wbo-inc']):
-        solution = (" ").join([str(idx+1) if(val == "1") else "-" + str(idx+1) for idx,val in enumerate(solution)])
 
-    
+def _learnModel(imli, X, y, isTest):
+    # X = pyrulelearn.utils._add_dummy_columns(X)
 
-    fields = [int(field) for field in solution.split()]
-    TrueRules = []
-    TrueErrors = []
-    zeroOneSolution = []
-        
+    num_features = X.shape[1]
+    num_samples = len(y)
 
-    for field in fields:
-        if (field > 0):
-            zeroOneSolution.append(1.0)
-        else:
-            zeroOneSolution.append(0.0)
-            
-        if (field > 0):
+    if (imli.ruleType == 'DNF'):
+        #  negate yVector for DNF rules
+        yVector = [1 - int(y[each_y]) for each_y in range(num_samples)]
+    elif(imli.ruleType == "CNF"):
+        yVector = y
+    else:
+        print("\n\nError rule type")
 
-            if (abs(field) <= imli.numClause * num_features):
-                TrueRules.append(field)
-            elif (imli.numClause * num_features < abs(field) <= imli.numClause * num_features + num_samples):
-                TrueErrors.append(field)
+    sampleWeight = None
+    if(imli.compress_duplicates and not isTest):
+        # identical (x, y) samples are one sample whose noise variable is weighted by their multiplicity
+        unique, sampleWeight, inverse = pyrulelearn.utils._unique_samples(X, yVector)
+        X = X[unique]
+        yVector = np.asarray(yVector)[unique]
+        num_samples = len(yVector)
+
+    if(imli.solver in _in_process_solvers):
+        # the previous batch warm starts the next one, only for rc2 as binary solvers take no initial assignment
+        warmStart = None
+        if(not isTest and len(imli._assignList) == imli.numClause * num_features):
+            warmStart = _warmStartAssignment(imli, X, yVector, num_features)
+        fields = _callInProcessSolver(imli, X, yVector, num_features, isTest, warmStart, sampleWeight)
+    else:
+        fields = _callSolver(imli, X, yVector, num_features, isTest, sampleWeight)
+
+    num_feature_variables = imli.numClause * num_features
+    TrueRules = fields[(fields > 0) & (fields <= num_feature_variables)]
+    num_errors = np.count_nonzero((fields > num_feature_variables) & (fields <= num_feature_variables + num_samples))
+    noise = fields[num_feature_variables:num_samples + num_feature_variables]
+    if(sampleWeight is not None and len(noise) == num_samples):
+        # noise of the samples of the batch, duplicates share the noise variable
+        num_errors = int(np.sum(sampleWeight[noise > 0]))
+        noise = noise[inverse]
+        num_samples = len(inverse)
+    zeroOneSolution = (fields > 0).astype(float)
 
     if (imli.verbose and isTest == False):
         print("\n\nBatch training complete")
         print("- number of literals in the rule: " + str(len(TrueRules)))
-        print("- number of training errors:    " + str(len(TrueErrors)) + " out of " + str(num_samples))
-    imli._xhat = []
-
-    for i in range(imli.numClause):
-        imli._xhat.append(np.array(
-            zeroOneSolution[i * num_features:(i + 1) * num_features]))
-    err = np.array(zeroOneSolution[num_features * imli.numClause: len(
-        X[0]) * imli.numClause + num_samples])
+        print("- number of training errors:    " + str(num_errors) + " out of " + str(num_samples))
 
+    imli._xhat = np.array([zeroOneSolution[i * num_features:(i + 1) * num_features] for i in range(imli.numClause)])
 
     if(imli.ruleType == "DNF"):
         actual_feature_len = int(imli.numFeatures/2)
-        imli._xhat = np.array([np.concatenate((each_xhat[actual_feature_len:], each_xhat[:actual_feature_len])) for each_xhat in imli._xhat])
-    if(imli.ruleType == "CNF"):
-        imli._xhat = np.array(imli._xhat)
+        imli._xhat = np.concatenate((imli._xhat[:, actual_feature_len:], imli._xhat[:, :actual_feature_len]), axis=1)
     
     
 
@@ -342,13 +672,13 @@ def _learnModel(imli, X, y, isTest):
     # os.system(cmd)
 
     if (not isTest):
-        imli._assignList = fields[:imli.numClause * num_features]
-        imli._selectedFeatureIndex = TrueRules
+        imli._assignList = fields[:num_feature_variables].tolist()
+        imli._selectedFeatureIndex = TrueRules.tolist()
         
         # print(imli._selectedFeatureIndex)
 
     
 
-    return fields[imli.numClause * num_features:num_samples + imli.numClause * num_features]
+    return noise
 
 
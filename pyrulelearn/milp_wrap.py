@@ -0,0 +1,342 @@
+import numpy as np
+import scipy.sparse
+from time import time
+import pyrulelearn.utils
+
+# MILP solvers for relaxed_CNF rules: "cplex" (IBM CPLEX, commercial) and "highs" (HiGHS, open-source)
+_MILP_SOLVERS = ["cplex", "highs"]
+
+# number of threads of the HiGHS scheduler, which is shared by all HiGHS instances of a process
+_highs_threads = None
+
+
+class _MILPModel():
+    """
+        MILP of a batch for relaxed_CNF: minimize objective . x subject to matrix x >= rhs (sense "G") or 
+        matrix x <= rhs (sense "L"), 0 <= x <= upper_bound, and x integer where integer is True. The matrix is 
+        a CSR matrix, one row per constraint. start is a feasible assignment of the variables built from the rule of 
+        the previous batch, or None.
+    """
+
+    def __init__(self, objective, upper_bound, integer, matrix, senses, rhs, num_feature_variables, num_samples, 
+                 var_eta_clause, var_eta_literal, ax_start):
+        self.objective = objective
+        self.upper_bound = upper_bound
+        self.integer = integer
+        self.matrix = matrix
+        self.senses = senses
+        self.rhs = rhs
+        self.num_feature_variables = num_feature_variables
+        self.num_samples = num_samples
+        self.var_eta_clause = var_eta_clause
+        self.var_eta_literal = var_eta_literal
+        self.ax_start = ax_start
+        self.start = None
+
+    def row_bounds(self):
+        # rhs as lower and upper bounds of the rows
+        row_lower = np.where(self.senses == "G", self.rhs, -np.inf)
+        row_upper = np.where(self.senses == "L", self.rhs, np.inf)
+        return row_lower, row_upper
+
+
+def _learnModel(imli, A, y):
+    """
+        Learns relaxed_CNF on the batch (A, y) with the MILP solver imli.solver and sets the learned rule.
+    """
+    start_generation_time = time()
+    sampleWeight = None
+    if(imli.compress_duplicates):
+        # identical (x, y) samples are one sample whose slack is weighted by their multiplicity
+        unique, sampleWeight, _ = pyrulelearn.utils._unique_samples(A, y)
+        A = A[unique]
+        y = np.asarray(y)[unique]
+    model = _relaxedCNFModel(imli, A, y, sampleWeight)
+    imli._wcnf_generation_time += time() - start_generation_time
+
+    solver_start_time = time()
+    if(imli.solver == "cplex"):
+        solution = _call_cplex(imli, model)
+    elif(imli.solver == "highs"):
+        solution = _call_highs(imli, model)
+    else:
+        raise ValueError(imli.solver + " is not a MILP solver, choose from " + str(_MILP_SOLVERS))
+    imli._solver_time += time() - solver_start_time
+
+    _setSolution(imli, model, solution)
+
+
+def _call_cplex(imli, model):
+    try:
+        import pyrulelearn.cplex_wrap
+    except ImportError:
+        raise ImportError("solver='cplex' requires the Python API of CPLEX, set solver='highs' for the open-source HiGHS solver")
+    return pyrulelearn.cplex_wrap._call_cplex(imli, model)
+
+
+def _relaxedCNFModel(imli, A, y, sampleWeight=None):
+    # A = pyrulelearn.utils._add_dummy_columns(A)
+    A = pyrulelearn.utils._to_dense(A)
+
+    no_features = -1
+    no_samples = len(y)
+    if(no_samples > 0):
+        no_features = len(A[0])
+    else:
+        print("- error: the dataset is corrupted, does not have sufficient samples")
+
+    if (imli.verbose):
+        print("- no of features: ", no_features)
+        print("- no of samples : ", no_samples)
+
+    # variables: feature b_{l,j} at l * no_features + j, slack s_i at numClause * no_features + i, 
+    # eta_clause, eta_clit_l and ax_{i,l} at ax_start + i * numClause + l
+    num_feature_variables = imli.numClause * no_features
+    variable_count = num_feature_variables + no_samples
+
+    var_eta_clause = -1
+    if (imli.learn_threshold_clause):
+        var_eta_clause = variable_count
+        variable_count += 1
+
+    var_eta_literal = [-1 for eachLevel in range(imli.numClause)]
+    if (imli.learn_threshold_literal):
+        # consider different threshold when learning mode is on
+        var_eta_literal = list(range(variable_count, variable_count + imli.numClause))
+        variable_count += imli.numClause
+
+    ax_start = variable_count
+    variable_count += no_samples * imli.numClause
+
+    # encode the objective function:
+
+    if(imli.verbose):
+        print("- weight feature: ", imli.weightFeature)
+        print("- weight error:   ", imli.dataFidelity)
+
+    objective_coefficient = np.zeros(variable_count)
+    objective_coefficient[:num_feature_variables] = imli.weightFeature
+    if(not (imli.iterations == 1 or len(imli._assignList) == 0)):  # is not called in the first iteration
+        objective_coefficient[:num_feature_variables][np.asarray(imli._assignList[:num_feature_variables]) > 0] = -imli.weightFeature
+    objective_coefficient[num_feature_variables: num_feature_variables + no_samples] = imli.dataFidelity if sampleWeight is None else imli.dataFidelity * np.asarray(sampleWeight)
+
+    upper_bound = np.ones(variable_count)
+    integer = np.arange(variable_count) >= num_feature_variables + no_samples
+    if (imli.learn_threshold_clause):
+        upper_bound[var_eta_clause] = imli.numClause
+    if (imli.learn_threshold_literal):
+        upper_bound[var_eta_literal] = no_features
+
+    # constraints are built as (row, variable, coefficient) entries, where entries of a row are in the order they are appended
+    rows, columns, values = [], [], []
+    senses, rhs = [], []
+    num_rows = 0
+
+    if (imli.learn_threshold_literal):
+        # sum_j b_{l,j} >= eta_clit_l
+        for eachLevel in range(imli.numClause):
+            rows.append(np.full(no_features + 1, eachLevel))
+            columns.append(np.array([eachLevel * no_features + j for j in range(no_features)] + [var_eta_literal[eachLevel]]))
+            values.append(np.array([1] * no_features + [-1]))
+        senses += ["G"] * imli.numClause
+        rhs += [0] * imli.numClause
+        num_rows += imli.numClause
+
+    # each sample has a constraint per clause followed by the constraint of the formula
+    y = np.asarray(y).reshape(-1) == 1
+    level = np.arange(imli.numClause)
+    sample = np.arange(no_samples)
+    sample_row = num_rows + sample * (imli.numClause + 1)
+    clause_row = (sample_row[:, None] + level).reshape(-1)
+    formula_row = sample_row + imli.numClause
+    ax_index = (ax_start + sample[:, None] * imli.numClause + level).reshape(-1)
+
+    # literals satisfied by the sample
+    nonzero_sample, nonzero_feature = np.nonzero(A)
+    rows.append((sample_row[nonzero_sample] + level[:, None]).reshape(-1))
+    columns.append((nonzero_feature + level[:, None] * no_features).reshape(-1))
+    values.append(np.tile(A[nonzero_sample, nonzero_feature], imli.numClause))
+
+    # ax_{i,l} relaxes the clause constraint
+    rows.append(clause_row)
+    columns.append(ax_index)
+    values.append(np.repeat(np.where(y, no_features, -no_features), imli.numClause))
+
+    if (imli.learn_threshold_literal):
+        rows.append(clause_row)
+        columns.append(np.tile(var_eta_literal, no_samples))
+        values.append(np.full(len(clause_row), -1))
+        clause_rhs = np.where(y, 0, -1)
+    else:
+        clause_rhs = np.where(y, imli.threshold_literal, imli.threshold_literal - 1)
+
+    # 1st slack variable = level * no_features
+    rows.append(formula_row)
+    columns.append(num_feature_variables + sample)
+    values.append(np.full(no_samples, imli.numClause))
+
+    if (imli.learn_threshold_clause):
+        rows.append(formula_row)
+        columns.append(np.full(no_samples, var_eta_clause))
+        values.append(np.where(y, -1, 1))
+        formula_rhs = np.where(y, - imli.numClause, 1)
+    else:
+        formula_rhs = np.where(y, - imli.numClause + imli.threshold_clause, - imli.threshold_clause + 1)
+
+    rows.append(np.repeat(formula_row, imli.numClause))
+    columns.append(ax_index)
+    values.append(np.full(len(ax_index), -1))
+
+    sample_senses = np.full((no_samples, imli.numClause + 1), "G")
+    sample_senses[~y, :imli.numClause] = "L"
+    sample_rhs = np.column_stack([np.repeat(clause_rhs[:, None], imli.numClause, axis=1), formula_rhs])
+    senses += sample_senses.reshape(-1).tolist()
+    rhs += sample_rhs.reshape(-1).tolist()
+    num_rows += no_samples * (imli.numClause + 1)
+
+    rows = np.concatenate(rows)
+    order = np.argsort(rows, kind="stable")
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=num_rows))))
+    matrix = scipy.sparse.csr_matrix((np.concatenate(values)[order].astype(float), np.concatenate(columns)[order], indptr), shape=(num_rows, variable_count))
+
+    model = _MILPModel(objective_coefficient, upper_bound, integer, matrix, np.array(senses), np.array(rhs, dtype=float), 
+                       num_feature_variables, no_samples, var_eta_clause, var_eta_literal, ax_start)
+    if(not (imli.iterations == 1 or len(imli._assignList) == 0)):
+        model.start = _warmStart(imli, model, A, y)
+    return model
+
+
+def _warmStart(imli, model, A, y):
+    """
+        Assignment of the model where the features and thresholds are those of the previous batch (imli._assignList and
+        threshold_*_learned), and ax and slack variables take their least feasible values on the batch.
+    """
+    num_feature_variables = model.num_feature_variables
+    if(len(imli._assignList) < num_feature_variables):
+        return None
+    no_features = num_feature_variables // imli.numClause
+    selected = (np.asarray(imli._assignList[:num_feature_variables]) > 0).reshape(imli.numClause, no_features)
+
+    threshold_literal = np.full(imli.numClause, imli.threshold_literal)
+    if(imli.learn_threshold_literal):
+        threshold_literal = np.asarray(getattr(imli, "threshold_literal_learned", threshold_literal))
+    threshold_clause = imli.threshold_clause
+    if(imli.learn_threshold_clause):
+        threshold_clause = getattr(imli, "threshold_clause_learned", threshold_clause)
+
+    # ax_{i,l} = 1 relaxes the constraint of clause l on sample i
+    count = np.asarray(A, dtype=np.int64) @ selected.T.astype(np.int64)
+    ax = np.where(y[:, None], count < threshold_literal, count >= threshold_literal).astype(float)
+    slack = np.where(y, ax.sum(axis=1) + threshold_clause - imli.numClause, 1 + ax.sum(axis=1) - threshold_clause) / imli.numClause
+
+    start = np.zeros(len(model.objective))
+    start[:num_feature_variables] = selected.reshape(-1)
+    start[num_feature_variables: num_feature_variables + model.num_samples] = np.clip(slack, 0, 1)
+    if(imli.learn_threshold_clause):
+        start[model.var_eta_clause] = threshold_clause
+    if(imli.learn_threshold_literal):
+        start[model.var_eta_literal] = threshold_literal
+    start[model.ax_start:] = ax.reshape(-1)
+    return start
+
+
+def _call_highs(imli, model):
+    """
+        Solves the model with HiGHS, through highspy (pip install highspy) when it is installed, which runs on 
+        imli._solver_threads() threads, and otherwise through scipy.optimize.milp (scipy>=1.9).
+    """
+    time_limit = max(imli._budget.call_limit(), 1)
+    if(imli.verbose):
+        print("- timelimit for solver: ",  time_limit)
+    row_lower, row_upper = model.row_bounds()
+    threads = imli._solver_threads()
+
+    try:
+        import highspy
+    except ImportError:
+        highspy = None
+
+    if(highspy is None):
+        try:
+            from scipy.optimize import milp, Bounds, LinearConstraint
+        except ImportError:
+            raise ImportError("solver='highs' requires the highspy package (pip install highspy), or scipy>=1.9 for scipy.optimize.milp")
+        options = {"time_limit": time_limit, "disp": bool(imli.verbose)}
+        if(imli.mip_gap is not None):
+            options["mip_rel_gap"] = imli.mip_gap
+        result = milp(model.objective, integrality=model.integer.astype(int), bounds=Bounds(0, model.upper_bound), 
+                      constraints=LinearConstraint(model.matrix, row_lower, row_upper), options=options)
+        if(imli.verbose):
+            print("- Solution status = ", result.message)
+        if(result.x is None):
+            raise ValueError("HiGHS did not find a solution: " + result.message)
+        return result.x
+
+    global _highs_threads
+    if(_highs_threads is not None and _highs_threads != threads):
+        # the scheduler is started with the threads of the first run
+        highspy.Highs.resetGlobalScheduler(True)
+    _highs_threads = threads
+
+    highs = highspy.Highs()
+    highs.setOptionValue("output_flag", bool(imli.verbose))
+    highs.setOptionValue("threads", threads)
+    highs.setOptionValue("time_limit", float(time_limit))
+    if(imli.mip_gap is not None):
+        highs.setOptionValue("mip_rel_gap", float(imli.mip_gap))
+
+    lp = highspy.HighsLp()
+    lp.num_col_, lp.num_row_ = model.matrix.shape[1], model.matrix.shape[0]
+    lp.col_cost_ = model.objective
+    lp.col_lower_ = np.zeros(len(model.objective))
+    lp.col_upper_ = model.upper_bound
+    lp.row_lower_ = row_lower
+    lp.row_upper_ = row_upper
+    lp.a_matrix_.format_ = highspy.MatrixFormat.kRowwise
+    lp.a_matrix_.num_col_, lp.a_matrix_.num_row_ = lp.num_col_, lp.num_row_
+    lp.a_matrix_.start_ = model.matrix.indptr
+    lp.a_matrix_.index_ = model.matrix.indices
+    lp.a_matrix_.value_ = model.matrix.data
+    lp.integrality_ = [highspy.HighsVarType.kInteger if integer else highspy.HighsVarType.kContinuous for integer in model.integer.tolist()]
+    highs.passModel(lp)
+    if(model.start is not None):
+        # incumbent, when feasible
+        start = highspy.HighsSolution()
+        start.col_value = model.start.tolist()
+        start.value_valid = True
+        highs.setSolution(start)
+    highs.run()
+
+    if(imli.verbose):
+        print("- Solution status = ", highs.modelStatusToString(highs.getModelStatus()))
+        print("- Objective value = ", highs.getInfo().objective_function_value)
+    if(highs.getInfo().primal_solution_status != 2):  # no feasible solution
+        raise ValueError("HiGHS did not find a solution: " + highs.modelStatusToString(highs.getModelStatus()))
+    return np.array(highs.getSolution().col_value)
+
+
+def _setSolution(imli, model, solution):
+    #  retrieve solution: do rounding
+    num_feature_variables = model.num_feature_variables
+    var_eta_clause, var_eta_literal = model.var_eta_clause, model.var_eta_literal
+
+    selected = solution[:num_feature_variables] > 0
+    imli._assignList = selected.astype(int).tolist() + solution[num_feature_variables: num_feature_variables + model.num_samples].tolist()
+    imli._selectedFeatureIndex = (np.nonzero(selected)[0] + 1).tolist()
+
+    # update parameters
+    if (imli.learn_threshold_clause and imli.learn_threshold_literal):
+
+        imli.threshold_literal_learned = [int(round(solution[var_eta_literal[eachLevel]])) for eachLevel in range(imli.numClause)]
+        imli.threshold_clause_learned = int(round(solution[var_eta_clause]))
+
+    elif (imli.learn_threshold_clause):
+        imli.threshold_literal_learned = [imli.threshold_literal for eachLevel in range(imli.numClause)]
+        imli.threshold_clause_learned = int(round(solution[var_eta_clause]))
+
+    elif (imli.learn_threshold_literal):
+        imli.threshold_literal_learned = [int(round(solution[var_eta_literal[eachLevel]])) for eachLevel in range(imli.numClause)]
+        imli.threshold_clause_learned = imli.threshold_clause
+
+    if(imli.verbose):
+        print("- MILP solver returned the solution")
@@ -0,0 +1,158 @@
+import numpy as np
+
+# The scorer only depends on numpy, so that it can be used for inference without the learning framework
+
+
+class RuleScorer():
+    """
+        Compiled rule learned by imli (see imli.get_scorer()). A clause l is satisfied by a sample when
+        the number of satisfied literals, i.e., x_j for j in positive literals and not x_j for j in negative literals,
+        is at least threshold_literal[l].
+
+        Samples are the binary features without complement columns, either as a 2D array or as rows packed by
+        pyrulelearn.utils.pack_binary_matrix. Working buffers are kept between calls, so a scorer should not be
+        shared between threads.
+    """
+
+    def __init__(self, rule_type, num_features, positive_index, positive_ptr, negative_index, negative_ptr,
+                 threshold_literal, threshold_clause, clause_target):
+        self.rule_type = str(rule_type)
+        self.num_features = int(num_features)
+        self.positive_index = np.asarray(positive_index, dtype=np.int64)
+        self.positive_ptr = np.asarray(positive_ptr, dtype=np.int64)
+        self.negative_index = np.asarray(negative_index, dtype=np.int64)
+        self.negative_ptr = np.asarray(negative_ptr, dtype=np.int64)
+        self.threshold_literal = np.asarray(threshold_literal, dtype=np.int64)
+        self.threshold_clause = int(threshold_clause)
+        self.clause_target = np.asarray(clause_target)
+        self.num_clause = len(self.threshold_literal)
+
+        # per-clause feature indices
+        self._positive = [self.positive_index[self.positive_ptr[l]: self.positive_ptr[l + 1]].tolist() for l in range(self.num_clause)]
+        self._negative = [self.negative_index[self.negative_ptr[l]: self.negative_ptr[l + 1]].tolist() for l in range(self.num_clause)]
+
+        if(self.rule_type == "decision sets"):
+            self._classes, self._clause_class = np.unique(self.clause_target, return_inverse=True)
+        self._workspace_size = -1
+
+    def __repr__(self):
+        return "<RuleScorer " + self.rule_type + ", " + str(self.num_clause) + " clauses>"
+
+    def save(self, file):
+        np.savez(file, rule_type=self.rule_type, num_features=self.num_features,
+                 positive_index=self.positive_index, positive_ptr=self.positive_ptr,
+                 negative_index=self.negative_index, negative_ptr=self.negative_ptr,
+                 threshold_literal=self.threshold_literal, threshold_clause=self.threshold_clause,
+                 clause_target=self.clause_target)
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file, allow_pickle=False) as data:
+            return cls(rule_type=data["rule_type"], num_features=data["num_features"],
+                       positive_index=data["positive_index"], positive_ptr=data["positive_ptr"],
+                       negative_index=data["negative_index"], negative_ptr=data["negative_ptr"],
+                       threshold_literal=data["threshold_literal"], threshold_clause=data["threshold_clause"],
+                       clause_target=data["clause_target"])
+
+    def predict(self, X, out=None):
+        """
+            X is a binary 2D array of shape (num_samples, num_features). The predictions are written to out,
+            if given.
+        """
+        assert X.shape[1] == self.num_features, str(self.num_features) + " " + str(X.shape[1])
+        return self._predict(X, len(X), self._dense_column, out)
+
+    def predict_packed(self, X, out=None):
+        """
+            X is either a PackedBinaryMatrix or its uint64 words, one row per sample.
+        """
+        words = getattr(X, "words", X)
+        assert words.shape[1] * 64 >= self.num_features
+        return self._predict(np.ascontiguousarray(words).view(np.uint8), len(words), self._packed_column, out)
+
+    def _dense_column(self, X, j):
+        return X[:, j]
+
+    def _packed_column(self, X, j):
+        # bit j of a row is bit j % 8 (little order) of byte j // 8
+        bit = self._bit[:len(X)]
+        np.right_shift(X[:, j >> 3], j & 7, out=bit)
+        np.bitwise_and(bit, 1, out=bit)
+        return bit
+
+    def _workspace(self, num_samples):
+        if(num_samples > self._workspace_size):
+            self._workspace_size = num_samples
+            self._count = np.empty(num_samples, dtype=np.int64)
+            self._satisfied = np.empty(num_samples, dtype=bool)
+            self._bit = np.empty(num_samples, dtype=np.uint8)
+            self._clause_count = np.empty(num_samples, dtype=np.int64)
+            if(self.rule_type == "decision sets"):
+                self._votes = np.empty((len(self._classes), num_samples), dtype=np.int64)
+                self._default = np.empty(num_samples, dtype=np.int64)
+                self._best = np.empty(num_samples, dtype=np.int64)
+
+    def _clause(self, X, num_samples, column, eachLevel):
+        # satisfied[i] = (number of satisfied literals of clause eachLevel in sample i) >= threshold
+        count = self._count[:num_samples]
+        count[:] = len(self._negative[eachLevel])
+        for j in self._positive[eachLevel]:
+            np.add(count, column(X, j), out=count, casting="unsafe")
+        for j in self._negative[eachLevel]:
+            np.subtract(count, column(X, j), out=count, casting="unsafe")
+        satisfied = self._satisfied[:num_samples]
+        np.greater_equal(count, self.threshold_literal[eachLevel], out=satisfied)
+        return satisfied
+
+    def _predict(self, X, num_samples, column, out):
+        self._workspace(num_samples)
+
+        if(self.rule_type in ["CNF", "DNF", "relaxed_CNF"]):
+            if(out is None):
+                out = np.empty(num_samples, dtype=int)
+            clause_count = self._clause_count[:num_samples]
+            clause_count[:] = 0
+            for eachLevel in range(self.num_clause):
+                np.add(clause_count, self._clause(X, num_samples, column, eachLevel), out=clause_count, casting="unsafe")
+            np.greater_equal(clause_count, self.threshold_clause, out=out, casting="unsafe")
+            return out
+
+        if(out is None):
+            out = np.empty(num_samples, dtype=self.clause_target.dtype)
+
+        if(self.rule_type == "decision lists"):
+            # rules are applied in reverse order, so that the first satisfied rule decides
+            for eachLevel in reversed(range(self.num_clause)):
+                np.copyto(out, self.clause_target[eachLevel], where=self._clause(X, num_samples, column, eachLevel))
+            return out
+
+        if(self.rule_type == "decision sets"):
+            # the last satisfied rule is the default outcome, other satisfied rules vote for their target
+            votes = self._votes[:, :num_samples]
+            votes[:] = 0
+            default = self._default[:num_samples]
+            default[:] = self._clause_class[-1]
+            for eachLevel in range(self.num_clause):
+                satisfied = self._clause(X, num_samples, column, eachLevel)
+                target = self._clause_class[eachLevel]
+                np.add(votes[target], satisfied, out=votes[target], casting="unsafe")
+                np.copyto(default, target, where=satisfied)
+
+            satisfied = self._satisfied[:num_samples]
+            for target in range(len(self._classes)):
+                np.equal(default, target, out=satisfied)
+                np.subtract(votes[target], satisfied, out=votes[target], casting="unsafe")
+
+            # most frequent, ties go to the smaller class
+            best = self._best[:num_samples]
+            count = self._count[:num_samples]
+            best[:] = default
+            count[:] = 0
+            for target in range(len(self._classes)):
+                np.greater(votes[target], count, out=satisfied)
+                np.copyto(best, target, where=satisfied)
+                np.copyto(count, votes[target], where=satisfied)
+            np.take(self._classes, best, out=out, mode="clip")
+            return out
+
+        raise ValueError(self.rule_type)
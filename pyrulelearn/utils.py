@@ -2,6 +2,10 @@ import Orange
 import numpy as np
 import pandas as pd
 import math
+import os
+import tempfile
+from time import time
+import scipy.sparse
 from sklearn.model_selection import train_test_split
 import random
 from feature_engine import discretisers as dsc
@@ -334,7 +338,331 @@ def _discretize(imli, file, categorical_column_index=[], column_seperator=",", f
     return X.values, y.values.ravel(), X.columns
 
 
+def _get_work_dir(imli):
+    # solver files are kept in memory (tmpfs) when no working directory is specified
+    if(imli.workDir is not None):
+        return imli.workDir
+    if(os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK)):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+# number of set bits in each byte
+_popcount_table = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)
+
+def _popcount(packed):
+    return int(_popcount_table[packed].sum())
+
+
+class PackedBinaryMatrix():
+    """
+        Binary feature matrix where each row is packed into uint64 words. The complement columns 
+        used by imli are implicit, i.e., the matrix behaves as np.hstack((X, 1 - X)) without storing it.
+        Use pack_binary_matrix(X) to construct it.
+    """
+
+    def __init__(self, words, num_features):
+        self.words = words
+        self.num_features = num_features
+        self.shape = (words.shape[0], 2 * num_features)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        if(isinstance(rows, tuple)):
+            raise IndexError("only rows of a PackedBinaryMatrix can be selected")
+        if(np.isscalar(rows)):
+            return self[[rows]].toarray()[0]
+        return PackedBinaryMatrix(self.words[rows], self.num_features)
+
+    def toarray(self):
+        X = np.unpackbits(np.ascontiguousarray(self.words).view(np.uint8), axis=1, count=self.num_features, bitorder="little").astype(bool)
+        return np.hstack((X, ~X))
+
+    def dot(self, xhat):
+        """
+            Returns self.toarray().dot(xhat.T), i.e., the number of satisfied literals of each clause (row of xhat) 
+            in each sample. For 0/1 clauses, literals x_j and not x_j are counted with AND and popcount on the 
+            packed words.
+        """
+        xhat = np.asarray(xhat)
+        num_samples, num_words = self.words.shape
+        result = np.empty((num_samples, len(xhat)), dtype=np.int64)
+        rows_per_block = max(_PACKED_BLOCK_SIZE // max(num_words, 1), 1)
+        
+        if(not np.array_equal(xhat, xhat.astype(bool))):
+            for start in range(0, num_samples, rows_per_block):
+                result[start: start + rows_per_block] = self[start: start + rows_per_block].toarray().dot(xhat.T)
+            return result
+
+        positive = _pack_rows(xhat[:, :self.num_features], num_words)
+        negative = _pack_rows(xhat[:, self.num_features:], num_words)
+        num_negative = xhat[:, self.num_features:].astype(bool).sum(axis=1)
+        for start in range(0, num_samples, rows_per_block):
+            words = self.words[start: start + rows_per_block]
+            for eachLevel in range(len(xhat)):
+                result[start: start + rows_per_block, eachLevel] = num_negative[eachLevel] + _popcount_rows(words & positive[eachLevel]) - _popcount_rows(words & negative[eachLevel])
+        return result
+
+
+class SparseBinaryMatrix():
+    """
+        Binary feature matrix stored as a scipy.sparse CSR matrix. As in PackedBinaryMatrix, the complement 
+        columns are implicit, so the memory scales with the number of non-zeros.
+    """
+
+    def __init__(self, csr):
+        self.csr = csr
+        self.num_features = csr.shape[1]
+        self.shape = (csr.shape[0], 2 * self.num_features)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        if(isinstance(rows, tuple)):
+            raise IndexError("only rows of a SparseBinaryMatrix can be selected")
+        if(np.isscalar(rows)):
+            return self[[rows]].toarray()[0]
+        return SparseBinaryMatrix(self.csr[rows])
+
+    def toarray(self):
+        X = self.csr.toarray().astype(bool)
+        return np.hstack((X, ~X))
+
+    def dot(self, xhat):
+        """
+            Returns self.toarray().dot(xhat.T) as a sparse-dense product, where x_j * w + (1 - x_j) * w' 
+            is computed as x_j * (w - w') + w'
+        """
+        xhat = np.asarray(xhat)
+        positive = xhat[:, :self.num_features]
+        negative = xhat[:, self.num_features:]
+        return np.asarray(self.csr.dot((positive - negative).T)) + negative.sum(axis=1)
+
+
+class MappedBinaryMatrix():
+    """
+        Binary feature matrix backed by a np.memmap, e.g., np.load(file, mmap_mode="r"). Selecting rows only 
+        records them (as a slice or as indices), so samples are read from the file when a batch is encoded or 
+        a block of samples is evaluated. As in PackedBinaryMatrix, the complement columns are implicit.
+    """
+
+    def __init__(self, memmap, rows=None):
+        self.memmap = memmap
+        self.rows = slice(0, len(memmap), 1) if rows is None else rows
+        self.num_features = memmap.shape[1]
+        self.shape = (len(self._indices()), 2 * self.num_features)
+
+    def __getstate__(self):
+        # only the selected rows are pickled, e.g., when a batch is sent to a worker
+        state = self.__dict__.copy()
+        state['memmap'] = np.asarray(self.memmap[self.rows])
+        state['rows'] = slice(0, len(self), 1)
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _indices(self):
+        if(isinstance(self.rows, slice)):
+            return range(len(self.memmap))[self.rows]
+        return self.rows
+
+    def __getitem__(self, rows):
+        if(isinstance(rows, tuple)):
+            raise IndexError("only rows of a MappedBinaryMatrix can be selected")
+        if(np.isscalar(rows)):
+            return self[[rows]].toarray()[0]
+        indices = self._indices()
+        if(isinstance(rows, slice) and isinstance(indices, range)):
+            indices = indices[rows]
+            return MappedBinaryMatrix(self.memmap, slice(indices.start, indices.stop, indices.step))
+        return MappedBinaryMatrix(self.memmap, np.asarray(indices)[rows])
+
+    def load(self):
+        # binary features of the selected rows, without complement columns
+        return np.asarray(self.memmap[self.rows]).astype(bool)
+
+    def toarray(self):
+        X = self.load()
+        return np.hstack((X, ~X))
+
+    def dot(self, xhat):
+        """
+            Returns self.toarray().dot(xhat.T), reading the file in blocks of samples
+        """
+        xhat = np.asarray(xhat)
+        positive = xhat[:, :self.num_features]
+        negative = xhat[:, self.num_features:]
+        result = np.empty((len(self), len(xhat)), dtype=np.result_type(xhat.dtype, np.int64))
+        # the product upcasts a block to the type of xhat
+        rows_per_block = max(_PACKED_BLOCK_SIZE // max(self.num_features, 1), 1)
+        for start in range(0, len(self), rows_per_block):
+            result[start: start + rows_per_block] = self[start: start + rows_per_block].load().dot((positive - negative).T) + negative.sum(axis=1)
+        return result
+
+
+# number of uint64 words handled at once by PackedBinaryMatrix
+_PACKED_BLOCK_SIZE = 1 << 20
+
+
+def _pack_rows(X, num_words):
+    packed = np.packbits(np.asarray(X).astype(bool), axis=1, bitorder="little")
+    words = np.zeros((len(packed), 8 * num_words), dtype=np.uint8)
+    words[:, :packed.shape[1]] = packed
+    return words.view(np.uint64)
+
+
+def _pack_columns(X):
+    """
+        Returns np.packbits(X, axis=0).T of binary features X, where each row holds the bits of one feature.
+        X is packed in blocks of rows, so it is not converted to bool as a whole.
+    """
+    num_samples, num_features = X.shape
+    packed = np.empty((num_features, (num_samples + 7) // 8), dtype=np.uint8)
+    # a multiple of 8 rows, so that blocks start at a byte
+    rows_per_block = 8 * max(_PACKED_BLOCK_SIZE // max(num_features, 1), 1)
+    for start in range(0, num_samples, rows_per_block):
+        block = np.asarray(X[start: start + rows_per_block]).astype(bool, copy=False)
+        packed[:, start // 8: (start + len(block) + 7) // 8] = np.packbits(block, axis=0).T
+    return packed
+
+
+def _popcount_rows(words):
+    return _popcount_table[words.view(np.uint8)].reshape(len(words), -1).sum(axis=1)
+
+
+def pack_binary_matrix(X):
+    """
+        Returns a PackedBinaryMatrix of binary features X, without complement columns. 
+        X is packed in blocks of rows, so a large array (or a memmap) is not copied as a whole.
+    """
+    num_samples, num_features = X.shape
+    num_words = (num_features + 63) // 64
+    words = np.empty((num_samples, num_words), dtype=np.uint64)
+    rows_per_block = max(8 * _PACKED_BLOCK_SIZE // max(num_features, 1), 1)
+    for start in range(0, num_samples, rows_per_block):
+        block = np.asarray(X[start: start + rows_per_block])
+        assert np.array_equal(block, block.astype(bool)), "Feature array is not binary. Try imli.discretize or imli.discretize_orange"
+        words[start: start + len(block)] = _pack_rows(block, num_words)
+    return PackedBinaryMatrix(words, num_features)
+
+
+def _has_implicit_complement(X):
+    return isinstance(X, (PackedBinaryMatrix, SparseBinaryMatrix, MappedBinaryMatrix))
+
+
+def _to_dense(X):
+    if(_has_implicit_complement(X)):
+        return X.toarray()
+    return X
+
+
+def _active_literals(X):
+    """
+        Returns the row and column indices of the non-zero entries of X (with complement columns) in row major order.
+        For a SparseBinaryMatrix, x_j are read from indptr/indices and not x_j are the remaining features of the row.
+    """
+    if(isinstance(X, SparseBinaryMatrix)):
+        # each row has num_features literals, x_j before not x_j. Rows are handled in blocks, 
+        # so that the mask of the complement is bounded, and literals are placed without sorting
+        num_samples, num_features = X.shape[0], X.num_features
+        rows = np.repeat(np.arange(num_samples), num_features)
+        cols = np.empty(num_samples * num_features, dtype=np.int64)
+        rows_per_block = max(_PACKED_BLOCK_SIZE // max(num_features, 1), 1)
+        for start in range(0, num_samples, rows_per_block):
+            csr = X.csr[start: start + rows_per_block]
+            indptr = csr.indptr.astype(np.int64)
+            block_rows = np.repeat(np.arange(csr.shape[0]), np.diff(indptr))
+            complement = np.ones(csr.shape, dtype=bool)
+            complement[block_rows, csr.indices] = False
+            complement_rows, complement_cols = np.nonzero(complement)
+            block_cols = cols[start * num_features: (start + csr.shape[0]) * num_features]
+            block_cols[block_rows * num_features + np.arange(len(block_rows)) - indptr[block_rows]] = csr.indices
+            # the m-th complement literal of the block follows the indptr[i + 1] literals x_j of rows up to i
+            block_cols[np.arange(len(complement_rows)) + indptr[complement_rows + 1]] = complement_cols + num_features
+        return rows, cols
+    return np.nonzero(_to_dense(X) == 1)
+
+
+def _clause_dot(X, xhat):
+    # number of satisfied literals of each clause (row of xhat) in each sample
+    if(_has_implicit_complement(X)):
+        return X.dot(xhat)
+    # considers non zero columns only
+    nonzero_columns = np.nonzero(np.any(xhat, axis=0))[0]
+    return X[:, nonzero_columns].dot(xhat[:, nonzero_columns].T)
+
+
+def _concatenate_rows(X, X_other):
+    if(isinstance(X, PackedBinaryMatrix)):
+        return PackedBinaryMatrix(np.concatenate((X.words, X_other.words)), X.num_features)
+    if(isinstance(X, SparseBinaryMatrix)):
+        return SparseBinaryMatrix(scipy.sparse.vstack((X.csr, X_other.csr), format="csr"))
+    if(isinstance(X, MappedBinaryMatrix)):
+        return MappedBinaryMatrix(X.memmap, np.concatenate((np.asarray(X._indices()), np.asarray(X_other._indices()))).astype(np.int64))
+    return np.concatenate((X, X_other))
+
+
+def _row_blocks(X, chunksize, header="infer"):
+    # consecutive blocks of at most chunksize samples, files are read lazily
+    if(isinstance(X, (str, os.PathLike))):
+        X = str(X)
+        if(not X.endswith(".npy")):
+            for df in pd.read_csv(X, chunksize=chunksize, header=header):
+                yield df.values
+            return
+        X = np.load(X, mmap_mode="r")
+    if(isinstance(X, pd.DataFrame)):
+        X = X.values
+    if(scipy.sparse.issparse(X)):
+        X = scipy.sparse.csr_matrix(X)
+    if(isinstance(X, SparseBinaryMatrix)):
+        # blocks of the num_features raw columns, without the implicit complement
+        X = X.csr
+    if(isinstance(X, MappedBinaryMatrix)):
+        for start in range(0, len(X), chunksize):
+            yield X[start: start + chunksize].load()
+        return
+    
+    if(isinstance(X, (np.ndarray, PackedBinaryMatrix)) or scipy.sparse.issparse(X)):
+        for start in range(0, X.shape[0], chunksize):
+            yield X[start: start + chunksize]
+        return
+    
+    for block in X:
+        yield block
+
+
+def _to_dense_block(X):
+    # binary features of a block of samples, without complement columns
+    if(scipy.sparse.issparse(X)):
+        return X.toarray()
+    if(isinstance(X, pd.DataFrame)):
+        return X.values
+    return np.asarray(X)
+
+
 def _transform_binary_matrix(X):
+    if(_has_implicit_complement(X)):
+        return X
+    if(scipy.sparse.issparse(X)):
+        X = scipy.sparse.csr_matrix(X, copy=True)
+        X.sum_duplicates()
+        X.eliminate_zeros()
+        assert np.all(X.data == 1), "Feature array is not binary. Try imli.discretize or imli.discretize_orange"
+        X = X.astype(bool)
+        X.sort_indices()
+        return SparseBinaryMatrix(X)
+    if(isinstance(X, np.memmap)):
+        # checked in blocks, the file is not loaded
+        rows_per_block = max(8 * _PACKED_BLOCK_SIZE // max(X.shape[1], 1), 1)
+        for start in range(0, len(X), rows_per_block):
+            block = np.asarray(X[start: start + rows_per_block])
+            assert np.array_equal(block, block.astype(bool)), "Feature array is not binary. Try imli.discretize or imli.discretize_orange"
+        return MappedBinaryMatrix(X)
     X = np.array(X)
     assert np.array_equal(X, X.astype(bool)), "Feature array is not binary. Try imli.discretize or imli.discretize_orange"
     X_complement = 1 - X
@@ -359,73 +687,130 @@ def _generateSamples(imli, XTrain, yTrain):
 
     return XTrain_sampled, yTrain_sampled
 
-def _numpy_partition(imli, X, y):
-    y = y.copy()
-    # based on numpy split
-    result = np.hstack((X,y.reshape(-1,1)))
-    # np.random.seed(22)
-    # np.random.shuffle(result)
-    result = np.array_split(result, imli.iterations)
-    return [np.delete(batch,-1, axis=1) for batch in result], [batch[:,-1] for batch in result]
-    
+class _RowBatches():
+    """
+        Batches of samples of X given as slices or indices. A batch is materialized only when it is accessed, 
+        and a slice of a dense array is a view.
+    """
+
+    def __init__(self, X, batches):
+        self.X = X
+        self.batches = batches
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        return self.X[self.batches[index]]
+
 
-def _getBatchWithEqualProbability(imli, X, y):
-    '''
-        Steps:
-            1. seperate data based on class value
-            2. Batch each seperate data into Batch_count batches using test_train_split method with 50% part in each
-            3. merge one seperate batche from each class and save
-        :param X:
-        :param y:
-        :param Batch_count:
-        :param location:
-        :param file_name_header:
-        :param column_set_list: uses for incremental approach
-        :return:
-        '''
-    Batch_count = imli.iterations
-    # y = y.values.ravel()
-    max_y = int(y.max())
-    min_y = int(y.min())
-
-    X_list = [[] for i in range(max_y - min_y + 1)]
-    y_list = [[] for i in range(max_y - min_y + 1)]
-    level = int(math.log(Batch_count, 2.0))
-    for i in range(len(y)):
-        inserting_index = int(y[i])
-        y_list[inserting_index - min_y].append(y[i])
-        X_list[inserting_index - min_y].append(X[i])
-
-    final_Batch_X_train = [[] for i in range(Batch_count)]
-    final_Batch_y_train = [[] for i in range(Batch_count)]
-    for each_class in range(len(X_list)):
-        Batch_list_X_train = [X_list[each_class]]
-        Batch_list_y_train = [y_list[each_class]]
-
-        for i in range(level):
-            for j in range(int(math.pow(2, i))):
-                A_train_1, A_train_2, y_train_1, y_train_2 = train_test_split(
-                    Batch_list_X_train[int(math.pow(2, i)) + j - 1],
-                    Batch_list_y_train[int(math.pow(2, i)) + j - 1],
-                    test_size=0.5,
-                    random_state = 22)  # random state for keeping consistency between lp and maxsat approach
-                Batch_list_X_train.append(A_train_1)
-                Batch_list_X_train.append(A_train_2)
-                Batch_list_y_train.append(y_train_1)
-                Batch_list_y_train.append(y_train_2)
-
-        Batch_list_y_train = Batch_list_y_train[Batch_count - 1:]
-        Batch_list_X_train = Batch_list_X_train[Batch_count - 1:]
-
-        for i in range(Batch_count):
-            final_Batch_y_train[i] = final_Batch_y_train[i] + Batch_list_y_train[i]
-            final_Batch_X_train[i] = final_Batch_X_train[i] + Batch_list_X_train[i]
-
-            # # to numpy
-            # final_Batch_X_train[i] = np.array(final_Batch_X_train[i])
-            # final_Batch_y_train[i] = np.array(final_Batch_y_train[i])
-
-
-    return final_Batch_X_train[:Batch_count], final_Batch_y_train[:Batch_count]
+def _partition(imli, X, y, shuffle=False, stratify=False, random_state=None):
+    """
+        Partitions the samples into imli.iterations batches without copying X and y.
 
+        By default, batches are consecutive samples as in np.array_split. With stratify, each batch has 
+        the class proportions of y, and with shuffle, samples are assigned to batches at random (seeded by random_state).
+    """
+    num_samples = len(y)
+    if(not shuffle and not stratify):
+        batch_sizes = [num_samples // imli.iterations + 1] * (num_samples % imli.iterations) + [num_samples // imli.iterations] * (imli.iterations - num_samples % imli.iterations)
+        boundaries = np.cumsum([0] + batch_sizes)
+        batches = [slice(start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
+        return _RowBatches(X, batches), _RowBatches(y, batches)
+
+    # samples are grouped by class (a single group without stratification), randomly ordered within a group when shuffled
+    group = np.zeros(num_samples, dtype=np.int64)
+    if(stratify):
+        group = np.unique(y, return_inverse=True)[1].reshape(-1)
+    if(shuffle):
+        order = np.lexsort((np.random.default_rng(random_state).random(num_samples), group))
+    else:
+        order = np.argsort(group, kind="stable")
+
+    # the r-th sample out of n in a group goes to batch r * iterations // n
+    group_size = np.bincount(group)
+    group_start = np.cumsum(group_size) - group_size
+    rank = np.arange(num_samples) - group_start[group[order]]
+    batch_of_sample = np.empty(num_samples, dtype=np.int64)
+    batch_of_sample[order] = rank * imli.iterations // group_size[group[order]]
+
+    # samples of a batch are kept in their original order
+    samples = np.argsort(batch_of_sample, kind="stable")
+    boundaries = np.cumsum(np.bincount(batch_of_sample, minlength=imli.iterations))
+    batches = np.split(samples, boundaries[:-1])
+    return _RowBatches(X, batches), _RowBatches(y, batches)
+
+
+class _TimeBudget():
+    """
+        Time budget of a fit (timeout in seconds). The time left is shared evenly by the rules that are not 
+        learned yet, so time not used by a rule goes to the following rules. Within a rule, the time is shared by 
+        its solver calls (batches of all outer passes): a call may use the time of the rule except the expected 
+        time of the remaining calls, estimated from the observed solve times.
+    """
 
+    def __init__(self, timeout, num_rules=1):
+        self.deadline = time() + timeout
+        self.num_rules = num_rules
+        self.start_rule(num_calls=1)
+
+    def split(self, num_rules):
+        # the budget is shared by num_rules rules, learned one after another
+        self.num_rules = num_rules
+
+    def start_rule(self, num_calls):
+        now = time()
+        self.rule_deadline = now + max(self.deadline - now, 0) / max(self.num_rules, 1)
+        self.num_rules = max(self.num_rules - 1, 0)
+        self.num_calls = max(num_calls, 1)
+        self.solve_times = []
+
+    def left(self):
+        return self.rule_deadline - time()
+
+    def total_left(self):
+        return self.deadline - time()
+
+    def expired(self):
+        return self.left() <= 0
+
+    def record(self, solve_time):
+        self.solve_times.append(solve_time)
+
+    def call_limit(self):
+        # time limit of the next solver call
+        left = max(self.left(), 0)
+        remaining_calls = max(self.num_calls - len(self.solve_times), 1)
+        if(len(self.solve_times) == 0):
+            return left / remaining_calls
+        expected = np.mean(self.solve_times) * (remaining_calls - 1)
+        return max(left / remaining_calls, left - expected)
+
+
+def _row_keys(X):
+    # rows of X packed into bytes, equal rows have equal keys
+    if(isinstance(X, PackedBinaryMatrix)):
+        return np.ascontiguousarray(X.words).view(np.uint8)
+    if(isinstance(X, SparseBinaryMatrix)):
+        num_samples = X.shape[0]
+        keys = np.zeros((num_samples, (X.num_features + 7) // 8), dtype=np.uint8)
+        rows = np.repeat(np.arange(num_samples), np.diff(X.csr.indptr))
+        np.bitwise_or.at(keys, (rows, X.csr.indices >> 3), np.left_shift(1, X.csr.indices & 7).astype(np.uint8))
+        return keys
+    if(isinstance(X, MappedBinaryMatrix)):
+        X = X.load()
+    return np.packbits(np.asarray(X).astype(bool), axis=1)
+
+
+def _unique_samples(X, y):
+    """
+        Returns the distinct (x, y) samples as the index of their first occurrence (in the order of X), their number
+        of occurrences and, for each sample, the position of its distinct sample. Samples with the same features and 
+        different labels are distinct.
+    """
+    keys = np.column_stack((_row_keys(X).reshape(len(y), -1), np.asarray(y).astype(np.uint8).reshape(-1)))
+    _, first, inverse, counts = np.unique(keys, axis=0, return_index=True, return_inverse=True, return_counts=True)
+    order = np.argsort(first)
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+    return first[order], counts[order], position[inverse.reshape(-1)]